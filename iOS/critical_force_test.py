@@ -1,5 +1,7 @@
 from src.reel import ReelNode, shader_src, digit_h, digit_w
 from src.tindeq import TindeqProgressor
+from src.analysis import WPrimeBalance, measure_mean_loads, fit_decay
+from src.session import Session
 from src.repeaters import *
 from scene import *
 from src.plotting import Plot
@@ -10,6 +12,26 @@ import time
 import math
 import cb
 import console
+import glob
+
+
+def last_critical_force(pattern='session_*.tdqs'):
+    '''
+    Critical force (kg) from the most recent saved test, or None
+    '''
+    # names are timestamped, so the last in order is the latest
+    paths = sorted(glob.glob(pattern))
+    if not paths:
+        return None
+    try:
+        session = Session(paths[-1])
+        tmeans, _, _, fmeans, _ = measure_mean_loads(
+            session.times, session.weights, reps=session.reps())
+        fit = fit_decay(tmeans, fmeans, session.work_time, session.rest_time, nboot=0)
+    except Exception:
+        return None
+    critical_force = fit['critical_load']
+    return critical_force if math.isfinite(critical_force) else None
 
 
 class CriticalForceTest(Scene):
@@ -37,6 +59,9 @@ class CriticalForceTest(Scene):
         self.num_intervals = 30
         self.num_sets_remaining = 1
         self.zeropoint = 0
+        # critical force (kg) from the last test; the W' gauge is hidden
+        # without one
+        self.critical_force = last_critical_force()
 
         # test y/n?
         self.mode = 'test'
@@ -67,9 +92,13 @@ class CriticalForceTest(Scene):
         msg_font = ('Avenir Next', 30)
         self.msgbox = LabelNode('scanning for device', msg_font, color='white')
         self.cyclebox = LabelNode('', msg_font, color='white')
+        # live W' used during the test
+        self.wbalbox = LabelNode('', msg_font, color='white')
+        self.wbal = WPrimeBalance(self.critical_force)
 
         self.root.add_child(self.msgbox)
         self.root.add_child(self.cyclebox)
+        self.root.add_child(self.wbalbox)
 
         self.plot = Plot(parent=self.root, xsize=0.35, ysize=0.2, position=(0, 0), nticks=5)
 
@@ -97,12 +126,14 @@ class CriticalForceTest(Scene):
         if self.size[0] > self.size[1]:
         	self.msgbox.position = self.size/5
         	self.cyclebox.position = self.size[0]/5, self.size[1]/3
+        	self.wbalbox.position = self.size[0]/5, self.size[1]/3 - 40
         	self.plot.position = self.size[0]/5, self.size[1]/5
         	self.plot.position = 0, -0.3
         else:
         	y = self.size[1]/3
         	self.msgbox.position = 0, -y
         	self.cyclebox.position = 0, -1.2*y
+        	self.wbalbox.position = 0, -1.4*y
         	self.plot.position = 0, 0
 
     def log_force_sample(self, tstamp, value):
@@ -110,9 +141,24 @@ class CriticalForceTest(Scene):
         self.times.append(tstamp)
         self.data.append(value - self.zeropoint)
 
+    def log_force_samples(self, tstamps, values):
+        if len(values) == 0:
+            return
+        values = values - self.zeropoint
+        self.msgbox.text = '{:.2f} kg'.format(values[-1])
+        self.times.extend(tstamps.tolist())
+        self.data.extend(values.tolist())
+        if self._state is RunningRepeaterState:
+            self.wbal.update(tstamps, values)
+            if math.isfinite(self.wbal.used):
+                self.wbalbox.text = "W' used: {:.0f} J".format(self.wbal.used)
+
     def log_rfd_sample(self, tstamp, value):
         pass
 
+    def log_rfd_samples(self, tstamps, values):
+        pass
+
     def update(self):
         self._state.update(self)
 
@@ -4,6 +4,7 @@ import console
 import os
 import numpy as np
 from .analysis import ResultsScene, analyse_data
+from .session import save_session
 
 data_slice = slice(-1024,-1)
 
@@ -45,6 +46,7 @@ class CountdownRepeaterState(object):
             # clear buffers
             scn.data = []
             scn.times = []
+            scn.wbal.reset()
             scn.start_time = time.time()
             # move to started state
             scn.background_color = '#00d300'
@@ -128,8 +130,12 @@ class StoppedRepeaterState(object):
         """
         Set to idle and start again (ask for confirmation as will overwrite data)
         """
-        np.savetxt('junk.txt', np.column_stack((scn.times, scn.data)))
-        msg, img = analyse_data('junk.txt', scn.work_interval, scn.rest_interval)
+        fname = time.strftime('session_%Y%m%d_%H%M%S.tdqs')
+        save_session(fname, scn.times, scn.data, scn.work_interval,
+                     scn.rest_interval, tare=scn.zeropoint,
+                     firmware=scn.tindeq.firmware,
+                     battery_mv=scn.tindeq.battery_mv)
+        msg, img = analyse_data(fname, scn.work_interval, scn.rest_interval)
         print(msg)
         mys = ResultsScene(scn, msg, img)
         scn.present_modal_scene(mys)
@@ -0,0 +1,196 @@
+'''
+Binary session files.
+
+A session file holds one test: sample times and weights as contiguous
+arrays, the work intervals found in them, and a JSON header with the test
+settings and device information. The layout is
+
+    8 bytes   magic, b'TDQSES01'
+    <I        length of the JSON header in bytes
+              JSON header, padded with spaces to a multiple of 64 bytes
+              float64 times (s)
+              float32 weights (kg)
+              int64 first sample of each work interval
+              int64 end (exclusive) of each work interval
+
+The header records the offset of each array, so files are loaded by
+memory-mapping them without copying or parsing any samples. The work
+intervals are those `measure_mean_loads` uses, so analysis can skip
+finding them again. Version 1 files stored the raw threshold crossings
+instead, which are not used.
+'''
+import json
+import time
+import struct
+
+import numpy as np
+
+from .analysis import find_reps, resolve_trigger_level
+
+MAGIC = b'TDQSES01'
+ALIGN = 64
+_prefix = struct.Struct('<8sI')
+
+
+def _aligned(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def save_session(
+    path,
+    times,
+    weights,
+    work_time,
+    rest_time,
+    tare=None,
+    firmware=None,
+    battery_mv=None,
+    trigger_level=3,
+    created=None,
+    auto_trigger=None,
+    **metadata,
+):
+    '''
+    Write a session file.
+
+    Parameters
+    ----------
+    path: str
+        File to write
+    times, weights: array-like
+        Sample times (s) and weights (kg)
+    work_time, rest_time: float
+        Length of the work and rest intervals (s)
+    tare, firmware, battery_mv: optional
+        Soft tare (kg), firmware version and battery voltage (mV)
+    trigger_level: float or 'auto'
+        Load (kg) used to find the work intervals stored in the file
+    created: float, optional
+        Time the test was recorded (Unix time), by default now
+    auto_trigger: bool, optional
+        Whether a numeric trigger_level was originally chosen automatically,
+        for rewriting an existing file. By default, trigger_level == 'auto'.
+    metadata:
+        Anything else to store in the header. Must be JSON serialisable.
+    '''
+    times = np.ascontiguousarray(times, dtype='<f8')
+    weights = np.ascontiguousarray(weights, dtype='<f4')
+    if auto_trigger is None:
+        auto_trigger = trigger_level == 'auto'
+    trigger_level = float(resolve_trigger_level(weights, trigger_level))
+    if len(times) > 1:
+        starts, ends = find_reps(weights, trigger_level)
+    else:
+        starts = ends = np.array([], dtype=np.int64)
+    starts = np.ascontiguousarray(starts, dtype='<i8')
+    ends = np.ascontiguousarray(ends, dtype='<i8')
+    arrays = dict(times=times, weights=weights, work_starts=starts, work_ends=ends)
+
+    header = dict(
+        version=2,
+        created=time.time() if created is None else created,
+        nsamples=len(times),
+        work_time=work_time,
+        rest_time=rest_time,
+        tare=None if tare is None else float(tare),
+        firmware=firmware,
+        battery_mv=battery_mv,
+        trigger_level=trigger_level,
+        auto_trigger=bool(auto_trigger),
+        metadata=metadata,
+    )
+    # array offsets depend on the header length, which depends on the
+    # offsets, so grow the header until everything fits
+    encoded = b''
+    while True:
+        header_len = _aligned(_prefix.size + len(encoded)) - _prefix.size
+        offset = _prefix.size + header_len
+        header['arrays'] = {}
+        for name, arr in arrays.items():
+            header['arrays'][name] = [offset, len(arr)]
+            offset = _aligned(offset + arr.nbytes)
+        encoded = json.dumps(header).encode('utf-8')
+        if len(encoded) <= header_len:
+            break
+    encoded = encoded.ljust(header_len)
+
+    with open(path, 'wb') as f:
+        f.write(_prefix.pack(MAGIC, header_len))
+        f.write(encoded)
+        for name, arr in arrays.items():
+            f.seek(header['arrays'][name][0])
+            f.write(arr.tobytes())
+
+
+class Session:
+    dtypes = dict(
+        times='<f8',
+        weights='<f4',
+        work_starts='<i8',
+        work_ends='<i8',
+        rising_edges='<i8',
+        falling_edges='<i8',
+    )
+
+    def __init__(self, path):
+        '''
+        A session file, memory-mapped.
+
+        The ``times``, ``weights``, ``work_starts`` and ``work_ends``
+        arrays are read-only views of the file. Header values are available
+        as attributes, e.g. ``session.work_time``.
+        '''
+        self.path = path
+        self._data = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, header_len = _prefix.unpack_from(self._data)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a session file')
+        start = _prefix.size
+        self.header = json.loads(bytes(self._data[start : start + header_len]))
+        for name, (offset, n) in self.header['arrays'].items():
+            dtype = np.dtype(self.dtypes[name])
+            view = self._data[offset : offset + n * dtype.itemsize].view(dtype)
+            setattr(self, name, view)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['header'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __len__(self):
+        return len(self.times)
+
+    def reps(self, trigger_level=3):
+        '''
+        Stored (starts, ends) of the work intervals, if they were found
+        with trigger_level, otherwise None
+        '''
+        if self.header.get('version', 1) < 2:
+            return None
+        if trigger_level == 'auto':
+            match = self.header['auto_trigger']
+        else:
+            match = not self.header['auto_trigger'] and (
+                float(trigger_level) == self.header['trigger_level']
+            )
+        return (self.work_starts, self.work_ends) if match else None
+
+
+def load_session(path):
+    return Session(path)
+
+
+def is_session_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_samples(path):
+    '''
+    Times and weights from a session file, or a legacy two column text file
+    '''
+    if is_session_file(path):
+        session = Session(path)
+        return session.times, session.weights
+    return np.loadtxt(path).T
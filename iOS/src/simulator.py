@@ -0,0 +1,249 @@
+'''
+Simulated Progressor, standing in for Pythonista's cb module.
+
+Install it before anything imports cb, then use the scripts as normal:
+
+    >>> from src import simulator
+    >>> simulator.install(speed=10)
+    >>> from src.tindeq import TindeqProgressor
+
+The module mirrors the parts of cb used by TindeqProgressor. The simulated
+device streams weight packets framed like a real Progressor from a
+background thread, answers commands, and can drop packets, send bursts and
+send low power warnings.
+'''
+import sys
+import time
+import struct
+import threading
+import numpy as np
+
+service_uuid = '7e4e1701-1ea6-40c9-9dcc-13d34ffead57'
+write_uuid = '7e4e1703-1ea6-40c9-9dcc-13d34ffead57'
+notify_uuid = '7e4e1702-1ea6-40c9-9dcc-13d34ffead57'
+sample_dtype = np.dtype([('weight', '<f4'), ('useconds', '<i4')])
+
+CMD_RESP, WEIGHT_MEASURE, RFD_PEAK, RFD_PEAK_SERIES, LOW_PWR = 0, 1, 2, 3, 4
+TARE_SCALE, START_WEIGHT_MEAS, STOP_WEIGHT_MEAS = 0x64, 0x65, 0x66
+START_PEAK_RFD_MEAS, START_PEAK_RFD_MEAS_SERIES = 0x67, 0x68
+GET_APP_VERSION, GET_ERR_INFO, CLR_ERR_INFO = 0x6b, 0x6c, 0x6d
+SLEEP, GET_BATT_VLTG = 0x6e, 0x6f
+
+_delegate = None
+peripheral = None
+
+
+def cft_profile(t, work_time=7, rest_time=3, peak=40.0, asymptote=18.0, tau=60.0):
+    '''force (kg) during an all-out repeater test, with exponential fatigue'''
+    t = np.asarray(t)
+    working = (t % (work_time + rest_time)) < work_time
+    return np.where(working, asymptote + (peak - asymptote) * np.exp(-t/tau), 0.0)
+
+
+def weight_packet(weights, useconds, kind=WEIGHT_MEASURE):
+    samples = np.empty(len(weights), dtype=sample_dtype)
+    samples['weight'] = weights
+    samples['useconds'] = useconds
+    payload = samples.tobytes()
+    return struct.pack('<bb', kind, len(payload)) + payload
+
+
+def response_packet(payload=b'', kind=CMD_RESP):
+    return struct.pack('<bb', kind, len(payload)) + payload
+
+
+class Characteristic:
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.value = None
+        self.notifying = False
+
+
+class Service:
+    def __init__(self, uuid, characteristics):
+        self.uuid = uuid
+        self.characteristics = characteristics
+
+
+class Peripheral:
+    def __init__(self, name='Progressor_SIM', sample_rate=80.0,
+                 rfd_sample_rate=1000.0, samples_per_packet=8, speed=1.0,
+                 profile=cft_profile, noise=0.2, drop_rate=0.0, latency=0.01, battery_mv=3900,
+                 firmware='1.2.3-sim', crash_log='', seed=None):
+        '''
+        A fake Progressor.
+
+        Device time runs ``speed`` times faster than real time; use
+        ``float('inf')`` to send packets as fast as possible. ``profile``
+        maps device time (s) to force (kg).
+        '''
+        self.name = name
+        self.uuid = 'SIMULATED-PROGRESSOR'
+        self.sample_rate = sample_rate
+        self.rfd_sample_rate = rfd_sample_rate
+        self.mode = WEIGHT_MEASURE
+        self.device_time = 0.0
+        self.samples_per_packet = samples_per_packet
+        self.speed = speed
+        self.profile = profile
+        self.noise = noise
+        self.drop_rate = drop_rate
+        self.latency = latency
+        self.battery_mv = battery_mv
+        self.firmware = firmware
+        self.crash_log = crash_log
+        self.rng = np.random.default_rng(seed)
+
+        self.notify_characteristic = Characteristic(notify_uuid)
+        self.write_characteristic = Characteristic(write_uuid)
+        self.services = []
+        self.tare_offset = 0.0
+        self.sample_count = 0
+        self.packets_sent = 0
+        self.packets_dropped = 0
+        self._burst = 0
+        self._streaming = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def rate(self):
+        return self.sample_rate if self.mode == WEIGHT_MEASURE else self.rfd_sample_rate
+
+    def discover_services(self):
+        self.services = [Service(service_uuid, [])]
+        _delegate.did_discover_services(self, None)
+
+    def discover_characteristics(self, s):
+        s.characteristics = [self.notify_characteristic, self.write_characteristic]
+        _delegate.did_discover_characteristics(s, None)
+
+    def set_notify_value(self, c, flag):
+        c.notifying = flag
+
+    def write_characteristic_value(self, c, data, with_response):
+        cmd = data[0]
+        if cmd == TARE_SCALE:
+            self.tare_offset = float(self.profile(self.device_time))
+            self._respond(b'')
+        elif cmd == START_WEIGHT_MEAS:
+            self.start(WEIGHT_MEASURE)
+        elif cmd == START_PEAK_RFD_MEAS:
+            self.start(RFD_PEAK)
+        elif cmd == START_PEAK_RFD_MEAS_SERIES:
+            self.start(RFD_PEAK_SERIES)
+        elif cmd in (STOP_WEIGHT_MEAS, SLEEP):
+            self.stop()
+        elif cmd == GET_BATT_VLTG:
+            self._respond(struct.pack('<I', self.battery_mv))
+        elif cmd == GET_APP_VERSION:
+            self._respond(self.firmware.encode('utf-8'))
+        elif cmd == GET_ERR_INFO:
+            self._respond(self.crash_log.encode('utf-8'))
+        elif cmd == CLR_ERR_INFO:
+            self.crash_log = ''
+
+    def low_power_warning(self):
+        self._notify(response_packet(kind=LOW_PWR))
+
+    def burst(self, npackets):
+        '''send the next npackets weight packets back to back'''
+        self._burst += npackets
+
+    def next_packet(self):
+        t = self.device_time + np.arange(self.samples_per_packet) / self.rate
+        self.device_time += self.samples_per_packet / self.rate
+        self.sample_count += self.samples_per_packet
+        if self.mode == WEIGHT_MEASURE:
+            values = self.profile(t) - self.tare_offset
+            if self.noise:
+                values = values + self.rng.normal(0, self.noise, len(t))
+        else:
+            # rate of force development, kg/s
+            dt = 1.0e-3
+            values = (self.profile(t + dt) - self.profile(t)) / dt
+        # device clock is a signed 32-bit microsecond counter
+        useconds = (np.round(t*1e6).astype(np.int64) + 2**31) % 2**32 - 2**31
+        return weight_packet(values, useconds, kind=self.mode)
+
+    def start(self, mode=WEIGHT_MEASURE):
+        self.mode = mode
+        if self._thread is None:
+            self._streaming.set()
+            self._thread = threading.Thread(target=self._stream, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._streaming.clear()
+        self._thread = None
+
+    def _respond(self, payload):
+        timer = threading.Timer(self.latency / self.speed, self._notify,
+                                (response_packet(payload),))
+        timer.daemon = True
+        timer.start()
+
+    def _notify(self, packet):
+        c = self.notify_characteristic
+        if _delegate is None or not c.notifying:
+            return
+        # cb delivers notifications one at a time
+        with self._lock:
+            c.value = packet
+            _delegate.did_update_value(c, None)
+
+    def _stream(self):
+        due = time.monotonic()
+        while self._streaming.is_set():
+            interval = self.samples_per_packet / self.rate / self.speed
+            packet = self.next_packet()
+            if self.drop_rate and self.rng.random() < self.drop_rate:
+                self.packets_dropped += 1
+            else:
+                self.packets_sent += 1
+                self._notify(packet)
+            if self._burst > 0:
+                self._burst -= 1
+                due = time.monotonic()
+                continue
+            due += interval
+            time.sleep(max(due - time.monotonic(), 0))
+
+
+def install(**kwargs):
+    '''
+    Register this module as cb, with a simulated peripheral built from kwargs
+    '''
+    global peripheral
+    peripheral = Peripheral(**kwargs)
+    sys.modules['cb'] = sys.modules[__name__]
+    return peripheral
+
+
+# the cb API
+def set_central_delegate(delegate):
+    global _delegate
+    _delegate = delegate
+
+
+def scan_for_peripherals():
+    if peripheral is not None:
+        _delegate.did_discover_peripheral(peripheral)
+
+
+def stop_scan():
+    pass
+
+
+def connect_peripheral(p):
+    _delegate.did_connect_peripheral(p)
+
+
+def cancel_peripheral_connection(p):
+    p.stop()
+    _delegate.did_disconnect_peripheral(p, None)
+
+
+def reset():
+    if peripheral is not None:
+        peripheral.stop()
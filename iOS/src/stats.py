@@ -0,0 +1,49 @@
+import numpy as np
+
+
+class RunningStats:
+    def __init__(self):
+        '''
+        Running mean and variance in constant memory.
+
+        Uses Welford's algorithm, extended to whole batches of samples with
+        the pairwise update of Chan et al, so packets can be added with one
+        vectorised call each.
+        '''
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        n = values.size
+        if n == 0:
+            return
+        batch_mean = values.mean()
+        batch_m2 = np.square(values - batch_mean).sum()
+        delta = batch_mean - self.mean
+        total = self.count + n
+        self.mean += delta * n / total
+        self._m2 += batch_m2 + delta**2 * self.count * n / total
+        self.count = total
+
+    @property
+    def variance(self):
+        return self._m2 / (self.count - 1) if self.count > 1 else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def sem(self):
+        '''
+        Standard error on the mean
+        '''
+        return self.std / np.sqrt(self.count) if self.count > 1 else np.nan
+
+    def converged(self, tolerance, min_samples=2):
+        '''
+        True once the standard error on the mean is below ``tolerance``
+        '''
+        return self.count >= max(min_samples, 2) and self.sem < tolerance
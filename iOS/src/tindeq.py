@@ -2,11 +2,13 @@ import cb
 import time
 import struct
 import numpy as np
+from .stats import RunningStats
 
 
 class TindeqProgressor(object):
     response_codes = {
-        'cmd_resp': 0, 'weight_measure': 1, 'low_pwr': 4
+        'cmd_resp': 0, 'weight_measure': 1, 'rfd_peak': 2,
+        'rfd_peak_series': 3, 'low_pwr': 4
     }
     cmds = dict(
         TARE_SCALE=0x64,
@@ -26,6 +28,7 @@ class TindeqProgressor(object):
     service_uuid = '7e4e1701-1ea6-40c9-9dcc-13d34ffead57'
     write_uuid = '7e4e1703-1ea6-40c9-9dcc-13d34ffead57'
     notify_uuid = '7e4e1702-1ea6-40c9-9dcc-13d34ffead57'
+    sample_dtype = np.dtype([('weight', '<f4'), ('useconds', '<i4')])
 
     def __init__(self, parent):
         """
@@ -45,9 +48,14 @@ class TindeqProgressor(object):
         self.write_characteristic = None
         self.read_characteristic = None
         self.info_struct = struct.Struct('<bb')
-        self.data_struct = struct.Struct('<fl')
         self.ready = False
         self._tare_value = 0.0
+        self._tare_stats = None
+        self.tare_noise = None
+        # last firmware version and battery voltage (mV) reported
+        self.firmware = None
+        self.battery_mv = None
+        self.logging = False
         self.parent = parent
 
     def log(self, msg):
@@ -98,22 +106,55 @@ class TindeqProgressor(object):
     def did_update_value(self, c, err):
         '''called whenever a notify service sends a msg'''
         self.last_val = c.value
-        kind, size = self.info_struct.unpack(c.value[:2])
+        kind, size = self.info_struct.unpack_from(c.value)
         if kind == self.response_codes['weight_measure']:
             # data sent in bulk packets
-            for weight, useconds in self.data_struct.iter_unpack(c.value[2:]):
-                now = useconds/1.0e6
-                if hasattr(self.parent, 'log_force_sample'):
-                    self.parent.log_force_sample(now, weight - self._tare_value)
+            times, weights = self.decode_samples(c.value)
+            self.log_samples(times, weights)
+            if self._tare_stats is not None:
+                self._tare_stats.update(weights)
+                self.check_tare()
+        elif kind in (self.response_codes['rfd_peak'],
+                      self.response_codes['rfd_peak_series']):
+            self.log_rfd_samples(*self.decode_samples(c.value, tare=False))
         elif kind == self.response_codes['cmd_resp']:
             self.cmd_response(c.value)
 
+    def decode_samples(self, value, tare=True):
+        '''view packet payload as arrays of times (s) and (tared) values'''
+        samples = np.frombuffer(
+            value, dtype=self.sample_dtype,
+            count=(len(value) - 2) // self.sample_dtype.itemsize, offset=2)
+        times = samples['useconds'] / 1.0e6
+        if not tare:
+            return times, samples['weight']
+        weights = samples['weight'] - np.float32(self._tare_value)
+        return times, weights
+
+    def log_rfd_samples(self, times, values):
+        '''pass a whole RFD packet to parent, one sample at a time if need be'''
+        if hasattr(self.parent, 'log_rfd_samples'):
+            self.parent.log_rfd_samples(times, values)
+        elif hasattr(self.parent, 'log_rfd_sample'):
+            for now, value in zip(times.tolist(), values.tolist()):
+                self.parent.log_rfd_sample(now, value)
+
+    def log_samples(self, times, weights):
+        '''pass a whole packet to parent, one sample at a time if need be'''
+        if hasattr(self.parent, 'log_force_samples'):
+            self.parent.log_force_samples(times, weights)
+        elif hasattr(self.parent, 'log_force_sample'):
+            for now, weight in zip(times.tolist(), weights.tolist()):
+                self.parent.log_force_sample(now, weight)
+
     def cmd_response(self, value):
         try:
             if self.last_cmd == 'get_app':
-                self.log(f"FW version : {value[2:].decode('utf-8')}")
+                self.firmware = value[2:].decode('utf-8')
+                self.log(f"FW version : {self.firmware}")
             elif self.last_cmd == 'get_batt':
                 vdd, = struct.unpack("<I", value[2:])
+                self.battery_mv = vdd
                 self.log(f"Battery level = {vdd} [mV]")
             elif self.last_cmd == 'get_err':
                 try:
@@ -177,38 +218,75 @@ class TindeqProgressor(object):
 
     def start_logging_weight(self):
         self.last_cmd = None
+        self.logging = True
         self._send_cmd('START_WEIGHT_MEAS')
 
     def end_logging_weight(self):
         self.last_cmd = None
+        self.logging = False
         self._send_cmd('STOP_WEIGHT_MEAS')
 
+    def start_peak_rfd(self):
+        '''measure peak rate of force development; stop with end_logging_weight'''
+        self.last_cmd = None
+        self.logging = True
+        self._send_cmd('START_PEAK_RFD_MEAS')
+
+    def start_peak_rfd_series(self):
+        self.last_cmd = None
+        self.logging = True
+        self._send_cmd('START_PEAK_RFD_MEAS_SERIES')
+
     def sleep(self):
         self.last_cmd = None
         self._send_cmd('SLEEP')
         self.peripheral = None
 
-    def soft_tare(self):
-        _saved_parent = self.parent
-        self.parent = SampleAverage()
-        self.start_logging_weight()
-        time.sleep(1)
-        self.end_logging_weight()
-        self._tare_value = self.parent.mean
-        self.parent = _saved_parent
-
-class SampleAverage:
-    def __init__(self):
-        self.weights = []
-
-    def log_force_sample(self, time, weight):
-        self.weights.append(weight)
+    def soft_tare(self, tolerance=0.01, timeout=2.0, min_samples=10,
+                  callback=None):
+        '''
+        Zero the weight readings in software, without blocking.
+
+        Running statistics of the readings are kept as packets arrive, and
+        the tare finishes as soon as the standard error on the mean is below
+        tolerance (kg), or after timeout seconds. Samples keep flowing to the
+        parent meanwhile. When done, callback (if given) is called with a
+        dict of the tare value, noise level (kg), samples used and whether
+        the tolerance was reached.
+        '''
+        self._tare_stats = RunningStats()
+        self._tare_criteria = (tolerance, min_samples)
+        self._tare_deadline = time.time() + timeout
+        self._tare_callback = callback
+        self._tare_started_logging = not self.logging
+        if self._tare_started_logging:
+            self.start_logging_weight()
 
     @property
-    def mean(self):
-        print(len(self.weights))
-        return np.mean(self.weights)
-
+    def tare_in_progress(self):
+        self.check_tare()
+        return self._tare_stats is not None
+
+    def check_tare(self):
+        '''finish the soft tare if it has converged or timed out'''
+        stats = self._tare_stats
+        if stats is None:
+            return
+        converged = stats.converged(*self._tare_criteria)
+        if not converged and time.time() < self._tare_deadline:
+            return
+        self._tare_stats = None
+        if self._tare_started_logging:
+            self.end_logging_weight()
+        if stats.count == 0:
+            self.log('no samples received during soft tare')
+            return
+        self._tare_value += stats.mean
+        self.tare_noise = stats.std
+        if self._tare_callback is not None:
+            self._tare_callback(dict(
+                tare=float(self._tare_value), noise=float(stats.std),
+                samples=stats.count, converged=bool(converged)))
 
 
 if __name__ == '__main__':
@@ -241,8 +319,9 @@ if __name__ == '__main__':
     time.sleep(0.5)
     delegate.get_batt()
     time.sleep(1)
-    delegate.soft_tare()
-    time.sleep(1)
+    delegate.soft_tare(callback=print)
+    while delegate.tare_in_progress:
+        time.sleep(0.1)
 
     print('go')
     wrap.active = True
@@ -0,0 +1,229 @@
+"""
+Benchmarks of the hot paths, on synthetic critical force tests.
+
+    python benchmark.py                 # run, print and record results
+    python benchmark.py --sizes 24 240  # test lengths, in reps
+    python benchmark.py --only edges    # benchmarks whose name contains "edges"
+    python benchmark.py --against 1a2b3c4  # compare with a recorded commit
+
+Each run is appended to a JSON lines history file with the git commit, so
+results can be compared between commits. The table printed after a run
+shows the change from the last recorded run at a different commit.
+"""
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import subprocess
+
+import numpy as np
+
+from src.tindeq import TindeqProgressor, DeviceCache
+from src.simulator import synthetic_trace, weight_packet
+from src.analysis import (
+    get_edges,
+    sigma_clipped_stats,
+    segment_sigma_clipped_stats,
+    measure_mean_loads,
+    analyse_data,
+)
+
+
+class NullSink:
+    def log_force_samples(self, times, weights):
+        pass
+
+
+def bench_decode(t, f):
+    packets = []
+    useconds = np.round(t * 1e6).astype(np.int64)
+    useconds = (useconds + 2**31) % 2**32 - 2**31
+    for i in range(0, len(t), 8):
+        packets.append(weight_packet(f[i : i + 8], useconds[i : i + 8]))
+    tindeq = TindeqProgressor(NullSink(), DeviceCache(path=None))
+
+    def run():
+        tindeq.clock.reset()
+        tindeq.metrics.reset()
+        for packet in packets:
+            tindeq._notify_handler(None, packet)
+
+    return run
+
+
+def bench_get_edges(t, f):
+    return lambda: get_edges(f)
+
+
+def bench_sigma_clip_rep(t, f):
+    rep = f[: int(7 * 80)]
+    return lambda: sigma_clipped_stats(rep)
+
+
+def bench_sigma_clip_segments(t, f):
+    rising, falling = get_edges(f)
+    n = min(len(rising), len(falling))
+    return lambda: segment_sigma_clipped_stats(f, rising[:n], falling[:n])
+
+
+def bench_measure_mean_loads(t, f):
+    return lambda: measure_mean_loads(t, f)
+
+
+def bench_analyse_data(t, f):
+    def run():
+        with np.errstate(all="ignore"):
+            analyse_data(t, f, 7, 3)
+
+    return run
+
+
+def bench_cft_update(t, f):
+    # the GUI is optional here, like everywhere else
+    from bokeh.document import Document
+    from critical_force import CFT
+    from src.analysis import IncrementalAnalyser
+
+    cft = CFT()
+    cft.make_document(Document())
+    # a whole test, one packet per update as at the 50 ms refresh
+    chunks = [(t[i : i + 8], f[i : i + 8]) for i in range(0, len(t), 8)]
+
+    def run():
+        cft.samples.clear()
+        cft.analyser = IncrementalAnalyser()
+        cft._fitted_reps = 0
+        cft.wbal.reset()
+        cft.wbal.critical_force = None
+        cft.source.data = {"x": [], "y": []}
+        cft.active = True
+        for times, weights in chunks:
+            cft.log_force_samples(times, weights)
+            cft.update()
+
+    return run
+
+
+benchmarks = {
+    "decode": bench_decode,
+    "get_edges": bench_get_edges,
+    "sigma_clip_rep": bench_sigma_clip_rep,
+    "sigma_clip_segments": bench_sigma_clip_segments,
+    "measure_mean_loads": bench_measure_mean_loads,
+    "analyse_data": bench_analyse_data,
+    "cft_update": bench_cft_update,
+}
+
+
+def time_call(func, min_time=0.2, repeat=5):
+    """
+    Best time per call (s), from repeats of at least min_time each.
+
+    Calls taking more than a second are not repeated; one sample of a slow
+    path is accurate enough, and keeps the large sizes affordable.
+    """
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    if elapsed > 1:
+        return elapsed / number
+    number = max(1, int(number * min_time / elapsed))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        )
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"]).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip() + ("-dirty" if dirty else "")
+
+
+def run(sizes, only=None, min_time=0.2, seed=0, noise=0.2, dropout=0.0):
+    results = []
+    for reps in sizes:
+        t, f = synthetic_trace(reps=reps, noise=noise, dropout=dropout, seed=seed)
+        for name, make in benchmarks.items():
+            if only and not any(word in name for word in only):
+                continue
+            try:
+                func = make(t, f)
+            except ImportError as err:
+                print(f"skipping {name}: {err}", file=sys.stderr)
+                continue
+            seconds = time_call(func, min_time)
+            results.append(dict(name=name, reps=reps, samples=len(t), seconds=seconds))
+            print(f"{name:>20s} {reps:6d} reps {seconds * 1e3:10.3f} ms", file=sys.stderr)
+    return results
+
+
+def load_history(path):
+    try:
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def compare(results, history, commit, against=None):
+    """
+    Print results next to the last run at a different commit, or at against
+    """
+    previous = {}
+    for record in history:
+        if against:
+            match = record.get("commit") == against
+        else:
+            match = record.get("commit") != commit
+        if match:
+            previous = {(r["name"], r["reps"]): r["seconds"] for r in record["results"]}
+            base = record.get("commit")
+    print(f"{'benchmark':>20s} {'reps':>6s} {'ms':>10s} {'change':>8s}")
+    for r in results:
+        old = previous.get((r["name"], r["reps"]))
+        change = f"{r['seconds'] / old - 1:+8.1%}" if old else ""
+        print(f"{r['name']:>20s} {r['reps']:6d} {r['seconds'] * 1e3:10.3f} {change:>8s}")
+    if previous:
+        print(f"change is relative to {base}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[24, 120], help="test lengths in reps"
+    )
+    parser.add_argument("--only", nargs="+", help="only run benchmarks with these in their name")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per measurement")
+    parser.add_argument("--noise", type=float, default=0.2, help="noise on the samples (kg)")
+    parser.add_argument("--dropout", type=float, default=0.0, help="fraction of packets lost")
+    parser.add_argument(
+        "--history", default="benchmark_history.jsonl", help="JSON lines file of past runs"
+    )
+    parser.add_argument("--against", help="commit to compare with (default: the last one)")
+    parser.add_argument("--no-record", action="store_true", help="don't add this run to history")
+    args = parser.parse_args(argv)
+
+    commit = git_commit()
+    results = run(args.sizes, args.only, args.min_time, noise=args.noise, dropout=args.dropout)
+    history = load_history(args.history)
+    compare(results, history, commit, args.against)
+    if not args.no_record:
+        record = dict(
+            commit=commit,
+            time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+            python=platform.python_version(),
+            numpy=np.__version__,
+            machine=platform.machine(),
+            settings=dict(noise=args.noise, dropout=args.dropout),
+            results=results,
+        )
+        with open(args.history, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+# puts this directory on sys.path, so tests can import src
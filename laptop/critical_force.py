@@ -1,16 +1,19 @@
-from src.tindeq import TindeqProgressor
-from src.analysis import analyse_data
+from src.tindeq import TindeqProgressor, DeviceCache
+from src.analysis import IncrementalAnalyser, WPrimeBalance
+from src.buffer import SampleBuffer
+from src.capture import CaptureWriter
+from src.session import save_session
+import re
 import time
+import argparse
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import asyncio
-import tornado
-from bokeh.server.server import Server
-from bokeh.application import Application
-from bokeh.application.handlers.function import FunctionHandler
-from bokeh.plotting import figure, ColumnDataSource
-from bokeh.layouts import row, column
-from bokeh.models import Button, Slider, Div, Band, Whisker
+
+# bokeh and tornado are imported where they are used, so the headless mode
+# and scripts importing this module don't pay for the GUI stack
 
 
 class IdleState:
@@ -23,7 +26,7 @@ class IdleState:
 
     @staticmethod
     def end(parent):
-        parent.state_start = time.time()
+        parent.state_start = time.monotonic()
         parent.state = CountDownState
 
 
@@ -34,7 +37,7 @@ class CountDownState:
     @staticmethod
     def update(parent):
         # count down timer
-        elapsed = time.time() - parent.state_start
+        elapsed = time.monotonic() - parent.state_start
         remain = CountDownState.duration - elapsed
         fs = int(10 * (remain - int(remain)))
         secs = int(remain)
@@ -45,7 +48,8 @@ class CountDownState:
 
     @staticmethod
     def end(parent):
-        parent.state_start = time.time()
+        parent.state_start = time.monotonic()
+        parent.rep_starts.append(parent.device_time(parent.state_start))
         parent.state = GoState
 
 
@@ -56,7 +60,7 @@ class GoState:
     @staticmethod
     def update(parent):
         # count down timer
-        elapsed = time.time() - parent.state_start
+        elapsed = time.monotonic() - parent.state_start
         remain = GoState.duration - elapsed
         fs = int(10 * (remain - int(remain)))
         secs = int(remain)
@@ -67,7 +71,7 @@ class GoState:
 
     @staticmethod
     def end(parent):
-        parent.state_start = time.time()
+        parent.state_start = time.monotonic()
         parent.state = RestState
 
 
@@ -79,7 +83,7 @@ class RestState:
     def update(parent):
         # count up timer
         # count down timer
-        elapsed = time.time() - parent.state_start
+        elapsed = time.monotonic() - parent.state_start
         remain = RestState.duration - elapsed
         fs = int(10 * (remain - int(remain)))
         secs = int(remain)
@@ -93,17 +97,26 @@ class RestState:
         if parent.test_done:
             parent.state = IdleState
         else:
-            parent.state_start = time.time()
+            parent.state_start = time.monotonic()
+            parent.rep_starts.append(parent.device_time(parent.state_start))
             parent.state = GoState
             parent.reps -= 1
 
 
 class CFT:
-    def __init__(self):
-        self.x = []
-        self.y = []
-        self.xnew = []
-        self.ynew = []
+    def __init__(self, critical_force=None):
+        self.samples = SampleBuffer()
+        # measures each rep as it ends, so results are ready with the last rep
+        self.analyser = IncrementalAnalyser()
+        # live W' used, against the athlete's last critical force if known,
+        # otherwise an estimate from the reps once the force levels off
+        self.critical_force = critical_force
+        self.wbal = WPrimeBalance(critical_force)
+        self._fitted_reps = 0
+        # device time at the start of each work interval
+        self.rep_starts = []
+        # tare, firmware and battery, saved with the session
+        self.device_info = {}
         self.active = False
         self.duration = 240
         self.reps = 24
@@ -111,20 +124,73 @@ class CFT:
         self.test_done = False
         self.analysed = False
         self.tindeq = None
-        io_loop = tornado.ioloop.IOLoop.current()
-        io_loop.add_callback(connect, self)
+        # saving and analysing at the end of the test happen here
+        self.executor = ThreadPoolExecutor(max_workers=1)
 
     def log_force_sample(self, time, weight):
         if self.active:
-            self.xnew.append(time)
-            self.ynew.append(weight)
-            self.x.append(time)
-            self.y.append(weight)
+            self.samples.append(time, weight)
+            self.analyser.update([time], [weight])
+            self.wbal.update([time], [weight])
+            self.update_critical_force()
 
-    def reset(self):
-        self.xnew, self.ynew = [], []
+    def log_force_samples(self, times, weights):
+        if self.active:
+            self.samples.extend(times, weights)
+            self.analyser.update(times, weights)
+            self.wbal.update(times, weights)
+            self.update_critical_force()
+
+    def update_critical_force(self):
+        """
+        Refit the provisional critical force each time a rep ends
+        """
+        if self.critical_force is not None or len(self.analyser) == self._fitted_reps:
+            return
+        self._fitted_reps = len(self.analyser)
+        cf = self.analyser.provisional_critical_force(GoState.duration, RestState.duration)
+        if cf is not None:
+            self.wbal.critical_force = cf
+
+    def log_low_power(self):
+        # saved with the session, as it can explain a poor recording
+        self.device_info["low_power"] = True
+
+    def device_time(self, host_time):
+        """
+        Device time matching a time.monotonic() value, NaN if unknown
+        """
+        try:
+            return self.tindeq.clock.to_device(host_time)
+        except (AttributeError, RuntimeError):
+            return np.nan
+
+    def save(self, path=None):
+        """
+        Save the test as a session file, and return its times and weights
+        """
+        if path is None:
+            path = time.strftime("session_%Y%m%d_%H%M%S.tdqs")
+        x, y = self.samples.session()
+        # device time of each work cue, to line the protocol up with the samples
+        rep_starts = [None if np.isnan(t) else float(t) for t in self.rep_starts]
+        save_session(
+            path,
+            x,
+            y,
+            GoState.duration,
+            RestState.duration,
+            rep_starts=rep_starts,
+            **self.device_info,
+        )
+        return x, y
 
     def make_document(self, doc):
+        import tornado
+        from bokeh.plotting import figure, ColumnDataSource
+        from bokeh.layouts import row, column
+        from bokeh.models import Button, Slider, Div
+
         source = ColumnDataSource(data=dict(x=[], y=[]))
         fig = figure(title="Real-time Data", sizing_mode="stretch_both")
         fig.line(x="x", y="y", source=source)
@@ -152,6 +218,10 @@ class CFT:
                 sizing_mode="stretch_width",
                 styles={"font-size": "150%", "color": "black", "text-align": "left"},
             )
+            self.wbal_div = Div(
+                text="W' used: --",
+                styles={"font-size": "250%", "color": "black", "text-align": "center"},
+            )
         except AttributeError:
             self.laps = Div(
                 text=f"Rep {0}/{duration_slider.value}",
@@ -171,9 +241,14 @@ class CFT:
                 sizing_mode="stretch_width",
                 style={"font-size": "150%", "color": "black", "text-align": "left"},
             )
+            self.wbal_div = Div(
+                text="W' used: --",
+                style={"font-size": "250%", "color": "black", "text-align": "center"},
+            )
             self.laps.styles = self.laps.style
             self.div.styles = self.div.style
             self.results_div.styles = self.results_div.style
+            self.wbal_div.styles = self.wbal_div.style
 
         def onclick():
             self.reps = duration_slider.value
@@ -182,7 +257,7 @@ class CFT:
             io_loop.add_callback(start_test, self)
 
         self.btn.on_click(onclick)
-        widgets = column(duration_slider, self.btn, self.laps, self.div)
+        widgets = column(duration_slider, self.btn, self.laps, self.div, self.wbal_div)
         first_row = row(widgets, fig)
         doc.add_root(column(first_row, self.results_div, sizing_mode="stretch_both"))
         self.source = source
@@ -190,63 +265,85 @@ class CFT:
         doc.add_periodic_callback(self.update, 50)
         self.doc = doc
 
-    def update(self):
-        if self.test_done and not self.analysed:
-            self.btn.label = "Test Complete"
-            np.savetxt("test.txt", np.column_stack((self.x, self.y)))
-            x = np.array(self.x)
-            y = np.array(self.y)
-            results = analyse_data(x, y, 7, 3)
-            (
-                tmeans,
-                fmeans,
-                e_fmeans,
-                msg,
-                critical_load,
-                load_asymptote,
-                predicted_force,
-            ) = results
-            self.results_div.text = msg
-
-            fill_src = ColumnDataSource(
-                dict(
-                    x=tmeans,
-                    upper=predicted_force,
-                    lower=load_asymptote * np.ones_like(tmeans),
-                )
+    def finish_test(self):
+        """
+        Save and analyse the test. Runs in the executor, off the event loop.
+        """
+        self.save()
+        results = self.analyser.results(GoState.duration, RestState.duration)
+        (
+            tmeans,
+            fmeans,
+            e_fmeans,
+            msg,
+            critical_load,
+            load_asymptote,
+            predicted_force,
+        ) = results
+        # glyph data, ready for the document
+        fill = dict(
+            x=tmeans,
+            upper=predicted_force,
+            lower=load_asymptote * np.ones_like(tmeans),
+        )
+        errors = dict(x=tmeans, upper=fmeans + e_fmeans, lower=fmeans - e_fmeans)
+        return msg, tmeans, fmeans, fill, errors
+
+    def show_results(self, future):
+        from bokeh.plotting import ColumnDataSource
+        from bokeh.models import Band, Whisker
+
+        try:
+            msg, tmeans, fmeans, fill, errors = future.result()
+        except Exception as err:
+            print(f"Analysis failed: {err}")
+            self.btn.label = "Analysis Failed"
+            return
+        self.btn.label = "Test Complete"
+        self.results_div.text = msg
+
+        self.fig.add_layout(
+            Band(
+                base="x",
+                lower="lower",
+                upper="upper",
+                source=ColumnDataSource(fill),
+                fill_alpha=0.7,
             )
-            self.fig.add_layout(
-                Band(
-                    base="x",
-                    lower="lower",
-                    upper="upper",
-                    source=fill_src,
-                    fill_alpha=0.7,
-                )
+        )
+        self.fig.circle(tmeans, fmeans, color="red", size=5, line_alpha=0)
+        self.fig.add_layout(
+            Whisker(
+                source=ColumnDataSource(errors),
+                base="x",
+                upper="upper",
+                lower="lower",
+                level="overlay",
             )
-            self.fig.circle(tmeans, fmeans, color="red", size=5, line_alpha=0)
+        )
 
-            esource = ColumnDataSource(
-                dict(x=tmeans, upper=fmeans + e_fmeans, lower=fmeans - e_fmeans)
-            )
-            self.fig.add_layout(
-                Whisker(
-                    source=esource,
-                    base="x",
-                    upper="upper",
-                    lower="lower",
-                    level="overlay",
+    def update(self):
+        if self.test_done and not self.analysed:
+            self.analysed = True
+            self.btn.label = "Analysing..."
+            self.btn.disabled = True
+            future = self.executor.submit(self.finish_test)
+            # add_next_tick_callback is the thread safe way into the document
+            future.add_done_callback(
+                lambda future: self.doc.add_next_tick_callback(
+                    partial(self.show_results, future)
                 )
             )
-            self.analysed = True
         else:
-            if self.tindeq is not None:
+            if self.tindeq is not None and not self.test_done:
                 self.btn.label = "Start Test"
             self.state.update(self)
-            self.source.stream({"x": self.xnew, "y": self.ynew})
+            xnew, ynew = self.samples.unread()
+            self.source.stream({"x": xnew.tolist(), "y": ynew.tolist()})
             nlaps = self.duration // 10
             self.laps.text = f"Rep {1 + nlaps - self.reps}/{nlaps}"
-            self.reset()
+            if self.active and np.isfinite(self.wbal.used):
+                self.wbal_div.text = f"W' used: {self.wbal.used:.0f} J"
 
 
 async def connect(cft):
@@ -258,11 +355,32 @@ async def connect(cft):
         print("Connection Failed ... check tindeq and restart app")
     else:
         cft.tindeq = tindeq
-        await cft.tindeq.soft_tare()
+        await read_device_info(cft)
         await asyncio.sleep(5)
 
 
+async def read_device_info(cft):
+    """
+    Soft tare the connected Progressor and note its firmware and battery
+    """
+    tare = await cft.tindeq.soft_tare()
+    try:
+        health = await cft.tindeq.health_check()
+    except asyncio.TimeoutError:
+        health = {}
+    cft.device_info = dict(
+        tare=tare["tare"],
+        firmware=health.get("firmware"),
+        battery_mv=health.get("battery_mv"),
+    )
+
+
 async def start_test(cft):
+    # keep every frame on disk as it arrives, in case we crash mid-test
+    recorder = CaptureWriter(
+        time.strftime("capture_%Y%m%d_%H%M%S.tdqcap"), tare=cft.device_info.get("tare")
+    )
+    cft.tindeq.recorder = recorder
     try:
         cft.state.end(cft)
         await cft.tindeq.start_logging_weight()
@@ -272,6 +390,9 @@ async def start_test(cft):
         cft.state.end(cft)
         cft.active = True
         await asyncio.sleep(cft.duration)
+        # packets in flight after STOP must not change the samples while
+        # finish_test reads them on the executor
+        cft.active = False
         await cft.tindeq.stop_logging_weight()
         cft.test_done = True
         await asyncio.sleep(0.5)
@@ -279,17 +400,135 @@ async def start_test(cft):
     except Exception as err:
         print(str(err))
     finally:
+        recorder.close()
+        cft.tindeq.recorder = None
         await cft.tindeq.disconnect()
         cft.tindeq = None
 
 
-cft = CFT()
-apps = {"/": Application(FunctionHandler(cft.make_document))}
-server = Server(apps, port=5006)
-server.start()
+def results_text(msg):
+    """
+    Plain text version of the HTML summary from the analysis
+    """
+    return re.sub(r"<[^>]+>", "", msg.replace("</p>", "\n")).strip()
+
+
+async def run_headless(cft, session=None, capture=None, simulate=False, speed=1.0):
+    """
+    Run the test protocol from the terminal, printing cues instead of a GUI.
+
+    Parameters
+    ----------
+    cft: CFT
+        Holds the samples and test settings (``reps``)
+    session, capture: str, optional
+        Session and capture files to write. Default to timestamped names.
+    simulate: bool
+        Use a simulated Progressor
+    speed: float
+        Speed up factor for the simulated Progressor. The protocol is run
+        this much faster too, so a simulated test takes 240 / speed seconds.
+    """
+    device = None
+    if simulate:
+        from src import simulator
+
+        # an in-memory cache, so the fake address never reaches the real one
+        tindeq = TindeqProgressor(cft, DeviceCache(path=None))
+        # no force until the test starts
+        device = simulator.add_device(speed=speed, profile=np.zeros_like)
+        simulator.use_simulator(tindeq)
+    else:
+        tindeq = TindeqProgressor(cft)
+        speed = 1.0
+    await tindeq.connect()
+    cft.tindeq = tindeq
+    await read_device_info(cft)
+    print(f"Connected, tare = {cft.device_info['tare']:.2f} kg")
+
+    if capture is None:
+        capture = time.strftime("capture_%Y%m%d_%H%M%S.tdqcap")
+    recorder = CaptureWriter(capture, tare=cft.device_info["tare"])
+    tindeq.recorder = recorder
+    try:
+        await tindeq.start_logging_weight()
+        for remain in range(CountDownState.duration, 0, -1):
+            print(f"Starting in {remain}...")
+            await asyncio.sleep(1 / speed)
+
+        if device is not None:
+            t0 = device.device_time
+            device.profile = lambda t: simulator.cft_profile(
+                np.asarray(t) - t0, GoState.duration, RestState.duration
+            )
+        cft.active = True
+        for rep in range(1, cft.reps + 1):
+            cft.rep_starts.append(cft.device_time(time.monotonic()))
+            print(f"Rep {rep}/{cft.reps}: pull")
+            await asyncio.sleep(GoState.duration / speed)
+            print(f"Rep {rep}/{cft.reps}: rest")
+            await asyncio.sleep(RestState.duration / speed)
+        cft.active = False
+        await tindeq.stop_logging_weight()
+    finally:
+        recorder.close()
+        tindeq.recorder = None
+        await tindeq.disconnect()
+        cft.tindeq = None
 
-if __name__ == "__main__":
+    cft.test_done = True
+    cft.save(session)
+    try:
+        msg = cft.analyser.results(GoState.duration, RestState.duration)[3]
+    except Exception as err:
+        print(f"Analysis failed: {err}")
+    else:
+        print(results_text(msg))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Critical force test")
+    parser.add_argument(
+        "--headless", action="store_true", help="run in the terminal, without the browser GUI"
+    )
+    parser.add_argument("--port", type=int, default=5006, help="port for the GUI server")
+    parser.add_argument("--reps", type=int, default=24, help="number of reps (headless)")
+    parser.add_argument("-o", "--output", help="session file to write (headless)")
+    parser.add_argument("--capture", help="capture file to write (headless)")
+    parser.add_argument(
+        "--simulate", action="store_true", help="use a simulated Progressor (headless)"
+    )
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="speed up factor for --simulate"
+    )
+    parser.add_argument(
+        "--critical-force",
+        type=float,
+        help="athlete's last critical force (kg), for the live W' gauge",
+    )
+    args = parser.parse_args(argv)
+
+    cft = CFT(args.critical_force)
+    if args.headless:
+        cft.reps = args.reps
+        cft.duration = cft.reps * 10
+        asyncio.run(run_headless(cft, args.output, args.capture, args.simulate, args.speed))
+        return
+
+    import tornado
+    from bokeh.server.server import Server
+    from bokeh.application import Application
+    from bokeh.application.handlers.function import FunctionHandler
+
+    apps = {"/": Application(FunctionHandler(cft.make_document))}
+    server = Server(apps, port=args.port)
+    server.start()
     io_loop = tornado.ioloop.IOLoop.current()
-    print("Opening Bokeh application on http://localhost:5006/")
+    io_loop.add_callback(connect, cft)
+    print(f"Opening Bokeh application on http://localhost:{args.port}/")
     io_loop.add_callback(server.show, "/")
     io_loop.start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Re-analyse recorded tests and write a summary table.
+
+    python reanalyse.py sessions/ "old/*.txt" -o summary.csv
+"""
+import sys
+import time
+import argparse
+
+from src.batch import find_sessions, reanalyse, write_summary
+from src.cache import AnalysisCache
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-analyse recorded tests")
+    parser.add_argument("paths", nargs="+", help="directories or glob patterns of session files")
+    parser.add_argument("-o", "--output", help="CSV file to write (default: stdout)")
+    parser.add_argument("-j", "--workers", type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument("--chunksize", type=int, help="files sent to a worker at a time")
+    parser.add_argument(
+        "--work", type=float, default=7, help="work time (s) for files that don't record it"
+    )
+    parser.add_argument(
+        "--rest", type=float, default=3, help="rest time (s) for files that don't record it"
+    )
+    parser.add_argument(
+        "--trigger",
+        default="3",
+        help='load (kg) separating work from rest, or "auto" to estimate it per file',
+    )
+    parser.add_argument(
+        "--nboot", type=int, default=1000, help="bootstrap resamples for the decay fit"
+    )
+    parser.add_argument(
+        "--cache",
+        nargs="?",
+        const=AnalysisCache.default_path,
+        help="reuse results from an analysis cache (default: %(const)s)",
+    )
+    args = parser.parse_args(argv)
+    trigger_level = args.trigger if args.trigger == "auto" else float(args.trigger)
+
+    paths = find_sessions(args.paths)
+    if not paths:
+        parser.error("no session files found")
+
+    rows = []
+    failed = 0
+    start = time.monotonic()
+    results = reanalyse(
+        paths,
+        args.work,
+        args.rest,
+        args.workers,
+        args.chunksize,
+        trigger_level,
+        args.nboot,
+        args.cache,
+    )
+    for i, row in enumerate(results, 1):
+        rows.append(row)
+        if row.get("error"):
+            failed += 1
+            print(f"[{i}/{len(paths)}] {row['file']}: {row['error']}", file=sys.stderr)
+        elif i % 10 == 0 or i == len(paths):
+            print(f"[{i}/{len(paths)}] {time.monotonic() - start:.1f} s", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            write_summary(rows, f)
+    else:
+        write_summary(rows, sys.stdout)
+    print(f"{len(paths) - failed} analysed, {failed} failed", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
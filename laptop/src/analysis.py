@@ -2,15 +2,140 @@
 import numpy as np
 
 
-def sigma_clipped_stats(data):
-    mask = np.ones(data.shape).astype('bool')
-    for i in range(5):
-        mean = np.mean(data[mask])
-        mask = np.fabs(data-mean) < 4 * np.std(data[mask])
-    return data[mask].mean(), np.median(data[mask]), data[mask].std()
+def sigma_clipped_stats(data, sigma=4, maxiters=5):
+    """
+    Mean, median and standard deviation of data, ignoring outliers.
+
+    Points more than sigma standard deviations from the mean are rejected,
+    and the statistics recalculated, up to maxiters times or until no
+    more points change. A 2-D array is clipped row by row, and gives
+    arrays of statistics.
+    """
+    data = np.asarray(data)
+    if data.ndim == 2:
+        nrows, ncols = data.shape
+        starts = np.arange(nrows) * ncols
+        return segment_sigma_clipped_stats(data.ravel(), starts, starts + ncols, sigma, maxiters)
+    mask = np.ones(data.shape, dtype='bool')
+    kept = data
+    for i in range(maxiters):
+        new_mask = np.fabs(data - kept.mean()) < sigma * kept.std()
+        # the next mask depends only on this one, so nothing more will change
+        if np.array_equal(new_mask, mask):
+            break
+        mask = new_mask
+        kept = data[mask]
+    return kept.mean(), np.median(kept), kept.std()
+
+
+def _segment_moments(x, seg, mask, nseg):
+    n = np.bincount(seg, weights=mask, minlength=nseg)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(seg, weights=np.where(mask, x, 0.0), minlength=nseg) / n
+        dev = np.where(mask, x - mean[seg], 0.0)
+        std = np.sqrt(np.bincount(seg, weights=dev*dev, minlength=nseg) / n)
+    return n.astype(np.int64), mean, std
+
+
+def segment_sigma_clipped_stats(data, starts, ends, sigma=4, maxiters=5):
+    """
+    sigma_clipped_stats for each segment data[start:end], in one pass.
+
+    Returns arrays of the clipped mean, median and standard deviation of
+    each segment, NaN where a segment has no points left.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(ends, dtype=np.int64) - starts
+    nseg = len(starts)
+    seg = np.repeat(np.arange(nseg), lengths)
+    # position of every point in data, segment by segment
+    idx = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    values = np.asarray(data)[idx]
+    x = values.astype(np.float64)
+
+    mask = np.ones(len(x), dtype='bool')
+    for i in range(maxiters):
+        n, mean, std = _segment_moments(x, seg, mask, nseg)
+        new_mask = np.fabs(x - mean[seg]) < sigma * std[seg]
+        # segments that have settled stay settled, so stop when all have
+        if np.array_equal(new_mask, mask):
+            break
+        mask = new_mask
+    else:
+        n, mean, std = _segment_moments(x, seg, mask, nseg)
+
+    # median: sort the surviving points by segment, then value. Sorting
+    # integer (segment, rank) keys is much quicker than np.lexsort.
+    kept = values[mask]
+    order = np.argsort(kept)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(kept))
+    kept = kept[np.argsort(seg[mask] * len(kept) + rank)]
+    first = np.cumsum(n) - n
+    median = np.full(nseg, np.nan)
+    ok = n > 0
+    lo = (first + (n - 1) // 2)[ok]
+    hi = (first + n // 2)[ok]
+    median[ok] = (kept[lo].astype(np.float64) + kept[hi]) / 2
+    return mean, median, std
+
+
+def estimate_trigger_level(f, bins=256):
+    """
+    Pick the load that separates work from rest from the data itself.
+
+    The samples are split into two classes with Otsu's method on their
+    histogram, and the level is put half way between the class medians,
+    so it sits in the middle of the gap between rest and work and a drift
+    in the tare of up to half the gap does not move samples across it.
+
+    Returns the level, and a confidence between 0 and 1: the fraction of
+    the load variance explained by the split. Clearly bimodal data, like a
+    repeater test, scores above about 0.8, and a single normal
+    distribution about 0.64.
+    """
+    f = np.asarray(f, dtype=np.float64)
+    f = f[np.isfinite(f)]
+    if len(f) < 2:
+        return np.nan, 0.0
+    # ignore the odd wild sample when choosing the histogram range
+    lo, hi = np.percentile(f, [0.5, 99.5])
+    if hi <= lo:
+        return np.nan, 0.0
+    counts, edges = np.histogram(f, bins=bins, range=(lo, hi))
+    centres = (edges[:-1] + edges[1:]) / 2
+    # weight and mean of the classes below and above each possible split
+    w0 = np.cumsum(counts)[:-1]
+    w1 = counts.sum() - w0
+    m0 = np.cumsum(counts * centres)[:-1]
+    m1 = (counts * centres).sum() - m0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        between = w0 * w1 * (m0/w0 - m1/w1)**2
+    k = np.nanargmax(between)
+    split = edges[k+1]
+
+    low, high = f[f < split], f[f >= split]
+    level = (np.median(low) + np.median(high)) / 2
+    total = counts.sum()
+    variance = np.sum(counts * (centres - (counts * centres).sum() / total)**2) * total
+    confidence = between[k] / variance if variance > 0 else 0.0
+    return float(level), float(confidence)
+
+
+def resolve_trigger_level(f, trigger_level, default=3, min_confidence=0.75):
+    """
+    trigger_level as a number, estimating it from f if it is 'auto'.
+
+    Falls back to the default if the estimate isn't confident.
+    """
+    if isinstance(trigger_level, str) and trigger_level == 'auto':
+        level, confidence = estimate_trigger_level(f)
+        return level if confidence >= min_confidence else default
+    return trigger_level
 
 
 def get_edges(f, trigger_level=3):
+    trigger_level = resolve_trigger_level(f, trigger_level)
     rising_edges = np.flatnonzero(np.logical_and(f[:-1] < trigger_level, f[1:] > trigger_level))
     falling_edges = np.flatnonzero(np.logical_and(f[:-1] > trigger_level, f[1:] < trigger_level))
     # check limits
@@ -19,30 +144,324 @@ def get_edges(f, trigger_level=3):
     return rising_edges, falling_edges
 
 
-def measure_mean_loads(t, f, trigger_level=3):
+def _runs(mask, carried):
+    """
+    Start (inclusive) and end (exclusive) of each run of True in mask.
+
+    carried is the start of a run continuing from before mask[0], or None.
+    """
+    edges = np.diff(mask.astype(np.int8), prepend=np.int8(0), append=np.int8(0))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if carried is not None and len(starts) and starts[0] == 0:
+        starts[0] = carried
+    return starts, ends
+
+
+class EdgeDetector:
+    def __init__(self, rise_level=3, fall_level=None, min_dwell=1):
+        """
+        Find the start and end of reps as the samples arrive.
+
+        A rep starts when the load has been above rise_level for min_dwell
+        samples in a row, and ends when it has been below fall_level for
+        min_dwell samples in a row. The gap between the two levels stops a
+        noisy load flickering across a single level from splitting reps,
+        and min_dwell rejects short spikes.
+
+        Edges are reported as get_edges does: the index of the last sample
+        before the load crossed the level. With the default fall_level and
+        min_dwell the edges are the same as get_edges, apart from samples
+        exactly at the level. Each chunk is handled with array operations,
+        and the edges do not depend on how the samples are split up.
+        """
+        self.rise_level = rise_level
+        self.fall_level = rise_level if fall_level is None else fall_level
+        if self.fall_level > self.rise_level:
+            raise ValueError('fall_level must not be above rise_level')
+        self.min_dwell = max(int(min_dwell), 1)
+        self.reset()
+
+    def reset(self):
+        self.high = False
+        self.reps = 0
+        self._index = 0
+        # start of the runs above and below the levels at the end of the last chunk
+        self._above = None
+        self._below = None
+
+    def update(self, f):
+        """
+        Process a chunk of samples, and return the indices of the rising and
+        falling edges confirmed by it, counting from the first sample ever.
+        """
+        f = np.asarray(f)
+        base = self._index
+        n = len(f)
+        self._index += n
+        if n == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        events = []
+        for is_rising, mask, carried in ((True, f > self.rise_level, self._above),
+                                         (False, f < self.fall_level, self._below)):
+            starts, ends = _runs(mask, None if carried is None else carried - base)
+            # a run only counts once it is min_dwell samples long
+            ok = np.minimum(ends, n) - starts >= self.min_dwell
+            events.append((starts[ok] + base, np.full(ok.sum(), is_rising)))
+            carried = starts[-1] + base if len(starts) and ends[-1] == n else None
+            if is_rising:
+                self._above = carried
+            else:
+                self._below = carried
+
+        starts = np.concatenate((events[0][0], events[1][0]))
+        kinds = np.concatenate((events[0][1], events[1][1]))
+        order = np.argsort(starts, kind='stable')
+        starts, kinds = starts[order], kinds[order]
+        # runs of the same kind in a row are one rep, or one rest
+        previous = np.concatenate(([self.high], kinds[:-1]))
+        new = kinds != previous
+        starts, kinds = starts[new], kinds[new]
+        if len(kinds):
+            self.high = bool(kinds[-1])
+        # the edge is the last sample before the run
+        edges = np.maximum(starts - 1, 0)
+        rising, falling = edges[kinds], edges[~kinds]
+        self.reps += len(rising)
+        return rising, falling
+
+    def find(self, f):
+        """
+        Rising and falling edges of a whole trace, like get_edges
+        """
+        self.reset()
+        return self.update(f)
+
+
+class WPrimeBalance:
+    def __init__(self, critical_force=None, wprime=np.nan):
+        """
+        Running W' balance, updated a batch of samples at a time.
+
+        W' is used at a rate of (force - critical force) while working and
+        recovered at the critical force while resting, as in the bookkeeping
+        of analyse_data. Only the total impulse and elapsed time are kept,
+        so the critical force can be set or changed at any time and `used`
+        is still exact for the new value.
+
+        Until critical_force is set, `used` is NaN. Early in a test the
+        force says nothing about the critical force, so use the athlete's
+        last result, or an estimate from the reps so far once the force has
+        levelled off.
+
+        Parameters
+        ----------
+        critical_force: float, optional
+            Critical force (kg)
+        wprime: float
+            W' at the start (J), if known, for `balance`
+        """
+        self.critical_force = critical_force
+        self.wprime = wprime
+        self.reset()
+
+    def reset(self):
+        self.impulse = 0.0
+        self.elapsed = 0.0
+        self._last = None
+
+    def update(self, times, weights):
+        times = np.asarray(times, dtype=np.float64)
+        if len(times) == 0:
+            return
+        weights = np.asarray(weights, dtype=np.float64)
+        previous = times[0] if self._last is None else self._last
+        dt = np.diff(times, prepend=previous)
+        self.impulse += float(np.dot(weights, dt))
+        self.elapsed += float(times[-1] - previous)
+        self._last = times[-1]
+
+    @property
+    def used(self):
+        """
+        W' used so far (J), NaN if the critical force is not known
+        """
+        if self.critical_force is None:
+            return np.nan
+        return 9.8 * (self.impulse - self.critical_force * self.elapsed)
+
+    @property
+    def balance(self):
+        """
+        W' left (J), if the starting W' is known
+        """
+        return self.wprime - self.used
+
+
+def find_reps(f, trigger_level=3, fall_level=None, min_dwell=1):
+    """
+    Start and end (exclusive) index of each work interval.
+
+    Intervals are found with an `EdgeDetector`; see there for fall_level
+    and min_dwell. trigger_level may be 'auto' to estimate it from the
+    data. Intervals of fewer than four samples are dropped.
+    """
+    trigger_level = resolve_trigger_level(f, trigger_level)
+    rising_edges, falling_edges = EdgeDetector(trigger_level, fall_level, min_dwell).find(f)
+    nreps = min(len(rising_edges), len(falling_edges))
+    s, e = rising_edges[:nreps], falling_edges[:nreps]
+    keep = e - s >= 3.5
+    return s[keep], e[keep]
+
+
+def measure_mean_loads(t, f, trigger_level=3, fall_level=None, min_dwell=1, reps=None):
     """
     Split the data into single work intervals, and calculate mean load in that interval
+
+    Intervals are found with `find_reps`, unless they are given as reps,
+    a (starts, ends) pair such as the one stored in a session file. All
+    intervals are measured together with segment operations on the full
+    arrays, so there is no Python loop over reps.
     """
-    rising_edges, falling_edges = get_edges(f, trigger_level)
-    fmeans = []; durations = []; fmeds = []; tmeans = []; errs = []
-    for s, e in zip(rising_edges, falling_edges):
-        if e-s < 3.5:
-            continue
+    if reps is None:
+        s, e = find_reps(f, trigger_level, fall_level, min_dwell)
+    else:
+        s, e = (np.asarray(index, dtype=np.intp) for index in reps)
+
+    t = np.asarray(t)
+    durations = t[e] - t[s]
+    if len(s):
+        # sums over [s0, e0), [e0, s1), [s1, e1)...; keep the work intervals
+        bounds = np.column_stack((s, e)).ravel()
+        tmeans = np.add.reduceat(t, bounds)[::2] / (e - s)
+    else:
+        tmeans = np.zeros(0)
+    fmeans, fmeds, std = segment_sigma_clipped_stats(f, s, e)
+    errs = std / np.sqrt(e - s)
+    return tmeans, durations, fmeans, fmeds, errs
+
+
+class IncrementalAnalyser:
+    def __init__(self, trigger_level=3, fall_level=None, min_dwell=1):
+        """
+        Measure each rep as the samples arrive.
+
+        Feed samples with `update`. Reps are found with an `EdgeDetector`,
+        and each work interval is measured as soon as its falling edge
+        arrives, as `measure_mean_loads` would, so `results` only has to
+        summarise the reps.
+        """
+        self.detector = EdgeDetector(trigger_level, fall_level, min_dwell)
+        self.tmeans, self.durations, self.fmeans, self.fmeds, self.errs = [], [], [], [], []
+        # samples of the open rep, or the last few samples between reps
+        self._t = np.zeros(0)
+        self._f = np.zeros(0, dtype=np.float32)
+        # index of the first kept sample, and of the open rep's rising edge
+        self._base = 0
+        self._start = None
 
-        elapsed = t[e]-t[s]
-        time = t[s:e].mean()
+    def __len__(self):
+        return len(self.fmeans)
+
+    def update(self, times, weights):
+        t = np.concatenate((self._t, times))
+        f = np.concatenate((self._f, weights))
+        rising, falling = self.detector.update(weights)
+        events = sorted([(i, True) for i in rising] + [(i, False) for i in falling])
+        for i, is_rising in events:
+            if is_rising:
+                self._start = i
+            elif self._start is not None:
+                self._close(t, f, self._start - self._base, i - self._base)
+                self._start = None
+
+        if self._start is None:
+            # the next rising edge can be up to min_dwell samples back
+            keep = max(len(f) - self.detector.min_dwell - 1, 0)
+        else:
+            keep = self._start - self._base
+        self._t, self._f = t[keep:], f[keep:]
+        self._base += keep
+
+    def _close(self, t, f, s, e):
+        if e-s < 3.5:
+            return
         mean, med, std = sigma_clipped_stats(f[s:e])
-        fmeans.append(mean)
-        fmeds.append(med)
-        durations.append(elapsed)
-        tmeans.append(time)
-        errs.append(std / np.sqrt(e-s))
-    return (np.array(tmeans), np.array(durations), np.array(fmeans),
-            np.array(fmeds), np.array(errs))
+        self.tmeans.append(t[s:e].mean())
+        self.durations.append(t[e]-t[s])
+        self.fmeans.append(mean)
+        self.fmeds.append(med)
+        self.errs.append(std / np.sqrt(e-s))
+
+    def mean_loads(self):
+        """
+        Rep measurements so far, as returned by measure_mean_loads
+        """
+        return (np.array(self.tmeans), np.array(self.durations), np.array(self.fmeans),
+                np.array(self.fmeds), np.array(self.errs))
+
+    def provisional_critical_force(self, load_time, rest_time, min_reps=6):
+        """
+        Critical force (kg) from the reps so far, or None if not known yet.
 
+        The rep forces are fitted with the decay of `fit_decay`, without the
+        bootstrap. The asymptote is only trusted once the reps span two
+        decay times, when the force has fallen most of the way to it.
+        """
+        if len(self) < min_reps:
+            return None
+        t = np.array(self.tmeans)
+        t -= t[0]
+        f = np.array(self.fmeds, dtype=np.float64)
+        span = t[-1]
+        taus = np.geomspace(span / 100, span * 100, 400)
+        fa, a, tau = _fit_decay_weighted(t, f, np.ones((1, len(t))), taus)
+        fa, a, tau = fa[0], a[0], tau[0]
+        if not (np.isfinite(fa) and a > 0 and fa > 0 and 2 * tau < span):
+            return None
+        return fa * load_time / (load_time + rest_time)
 
-def analyse_data(t, f, load_time, rest_time, interactive=False):
-    tmeans, durations, _, fmeans, e_fmeans = measure_mean_loads(t, f)
+    def results(self, load_time, rest_time):
+        """
+        Same as analyse_data for the samples so far
+        """
+        tmeans, durations, _, fmeans, e_fmeans = self.mean_loads()
+        return summarise(tmeans, durations, fmeans, e_fmeans, load_time, rest_time)
+
+
+def analyse_data(t, f, load_time, rest_time, interactive=False, trigger_level=3):
+    tmeans, durations, _, fmeans, e_fmeans = measure_mean_loads(t, f, trigger_level)
+    return summarise(tmeans, durations, fmeans, e_fmeans, load_time, rest_time)
+
+
+def summarise(tmeans, durations, fmeans, e_fmeans, load_time, rest_time):
+    """
+    Critical force results from the mean load in each rep
+    """
+    res = critical_force(tmeans, durations, fmeans, e_fmeans, load_time, rest_time)
+    msg = '<p>peak load = {:.2f} +/- {:.2f} kg</p>'.format(res['peak_load'], res['e_peak_load'])
+    msg += '<p>critical load = {:.2f} +/- {:.2f} kg</p>'.format(res['critical_load'], res['e_critical_load'])
+    msg += '<p>asymptotic load = {:.2f} +/- {:.2f} kg</p>'.format(res['load_asymptote'], res['e_load_asymptote'])
+    msg += "<p>W'' = {:.0f} J</p>".format(res['wprime'])
+    msg += '<p>Anaerobic function score = {:.1f}</p>'.format(res['anaerobic_score'])
+    fit = fit_decay(tmeans, fmeans, load_time, rest_time, seed=0)
+    msg += '<p>critical load (decay fit) = {:.2f} +/- {:.2f} kg</p>'.format(
+        fit['critical_load'], fit['e_critical_load'])
+    msg += "<p>W'' (decay fit) = {:.0f} +/- {:.0f} J</p>".format(fit['wprime'], fit['e_wprime'])
+    msg += '<p>fatigue time constant = {:.0f} +/- {:.0f} s</p>'.format(fit['tau'], fit['e_tau'])
+
+    return (tmeans, fmeans, e_fmeans, msg, res['critical_load'], res['load_asymptote'],
+            res['predicted_force'])
+
+
+def critical_force(tmeans, durations, fmeans, e_fmeans, load_time, rest_time):
+    """
+    Fit the critical force model to the mean load in each rep.
+
+    Returns a dict of results: peak load, critical load and asymptotic load
+    with their errors (kg), W' (J), the anaerobic function score and the
+    predicted maximum force in each rep.
+    """
     factor = load_time / (load_time + rest_time)
     load_asymptote = np.nanmean(fmeans[-5:-1])
     e_load_asymptote = np.nanstd(fmeans[-5:-1]) / np.sum(np.isfinite(fmeans[-5:-1]))
@@ -56,13 +475,149 @@ def analyse_data(t, f, load_time, rest_time, interactive=False):
 
     # force constant
     alpha = np.median((fmeans - load_asymptote)/remaining)
+    predicted_force = load_asymptote + alpha * remaining
 
-    msg = '<p>peak load = {:.2f} +/- {:.2f} kg</p>'.format(fmeans[0], e_fmeans[0])
-    msg += '<p>critical load = {:.2f} +/- {:.2f} kg</p>'.format(critical_load, e_critical_load)
-    msg += '<p>asymptotic load = {:.2f} +/- {:.2f} kg</p>'.format(load_asymptote, e_load_asymptote)
-    msg += "<p>W'' = {:.0f} J</p>".format(9.8 * wprime_alt)
-    msg += '<p>Anaerobic function score = {:.1f}</p>'.format(wprime_alt / critical_load)
+    return dict(
+        reps=len(fmeans),
+        peak_load=fmeans[0],
+        e_peak_load=e_fmeans[0],
+        critical_load=critical_load,
+        e_critical_load=e_critical_load,
+        load_asymptote=load_asymptote,
+        e_load_asymptote=e_load_asymptote,
+        wprime=9.8 * wprime_alt,
+        anaerobic_score=wprime_alt / critical_load,
+        predicted_force=predicted_force,
+    )
 
-    predicted_force = load_asymptote + alpha * remaining
 
-    return tmeans, fmeans, e_fmeans, msg, critical_load, load_asymptote, predicted_force
+def _fit_decay_weighted(t, f, weights, taus):
+    """
+    Weighted least squares fit of f = fa + a exp(-t/tau), for each row of
+    weights at once.
+
+    For a fixed tau the model is linear, so fa and a have a closed form.
+    The best tau is found on the grid taus, then refined by fitting a
+    parabola to the residuals in log(tau).
+    """
+    def linear_fit(sw, sx, sxx, sy, sxy):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            a = (sw * sxy - sx * sy) / (sw * sxx - sx * sx)
+            fa = (sy - a * sx) / sw
+        return fa, a
+
+    # sums over reps for every (resample, tau) pair, shape (nfit, ntau)
+    x = np.exp(-t[None, :] / taus[:, None])
+    sw = weights.sum(axis=1)[:, None]
+    sy = (weights @ f)[:, None]
+    syy = (weights @ (f * f))[:, None]
+    sx = weights @ x.T
+    sxx = weights @ (x * x).T
+    sxy = (weights * f) @ x.T
+    fa, a = linear_fit(sw, sx, sxx, sy, sxy)
+    rss = syy - 2*fa*sy - 2*a*sxy + fa*fa*sw + 2*fa*a*sx + a*a*sxx
+    rss = np.where(np.isfinite(rss), rss, np.inf)
+
+    k = np.clip(np.argmin(rss, axis=1), 1, len(taus) - 2)
+    rows = np.arange(len(weights))
+    r0, r1, r2 = rss[rows, k-1], rss[rows, k], rss[rows, k+1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shift = np.clip(0.5 * (r0 - r2) / (r0 - 2*r1 + r2), -1, 1)
+    shift = np.where(np.isfinite(shift), shift, 0.0)
+    log_taus = np.log(taus)
+    tau = np.exp(log_taus[k] + shift * (log_taus[1] - log_taus[0]))
+
+    # final fit at each resample's own tau
+    x = np.exp(-t[None, :] / tau[:, None])
+    fa, a = linear_fit(sw[:, 0], np.sum(weights * x, axis=1), np.sum(weights * x * x, axis=1),
+                       sy[:, 0], np.sum(weights * x * f, axis=1))
+    return fa, a, tau
+
+
+def _bootstrap_decay(t, f, taus, nboot, seed):
+    rng = np.random.default_rng(seed)
+    n = len(t)
+    weights = rng.multinomial(n, np.full(n, 1/n), size=nboot).astype(np.float64)
+    return _fit_decay_weighted(t, f, weights, taus)
+
+
+def fit_decay(tmeans, fmeans, load_time, rest_time, nboot=1000, seed=None, workers=1):
+    """
+    Fit the per-rep force with an exponential decay towards an asymptote,
+
+        F = Fa + (F0 - Fa) exp(-(t - t0) / tau)
+
+    where t0 is the time of the first rep. Critical force is Fa scaled by
+    the fraction of time spent working, and W' is the work done above it,
+    the area under the decay: factor * (F0 - Fa) * tau, in the same units
+    as analyse_data.
+
+    This is the model of force against remaining W' used by
+    critical_force, F = Fa + alpha * W'remaining, written in time. Each
+    cycle uses factor * (F - Fa) of W' per second, so W'remaining, and
+    with it F - Fa, decays exponentially with tau = 1 / (factor * alpha).
+    Fitting in time avoids fitting against a W'remaining series that is
+    itself built from the asymptote being fitted. alpha is returned too.
+
+    Uncertainties come from bootstrap resampling of the reps. All the
+    resamples are fitted at once, and with workers > 1 they are shared
+    across a process pool, each worker with its own random stream.
+
+    Returns a dict with the best fit critical_load, load_asymptote, peak
+    load (F0), wprime, tau and alpha, the standard deviation of each over the
+    resamples (e_critical_load...), their 95% intervals (ci_critical_load...)
+    and the predicted force at each rep.
+    """
+    t = np.asarray(tmeans, dtype=np.float64)
+    f = np.asarray(fmeans, dtype=np.float64)
+    ok = np.isfinite(t) & np.isfinite(f)
+    t, f = t[ok], f[ok]
+    names = ['critical_load', 'load_asymptote', 'peak_load', 'wprime', 'tau', 'alpha']
+    if len(t) < 4:
+        res = {name: np.nan for name in names}
+        res.update({'e_' + name: np.nan for name in names})
+        res.update({'ci_' + name: (np.nan, np.nan) for name in names})
+        res['predicted_force'] = np.full(len(tmeans), np.nan)
+        return res
+    t0 = t[0]
+    t = t - t0
+    span = max(t[-1], load_time + rest_time)
+    taus = np.geomspace(span / 100, span * 100, 400)
+    factor = load_time / (load_time + rest_time)
+
+    def derived(fa, a, tau):
+        return dict(
+            critical_load=fa * factor,
+            load_asymptote=fa,
+            peak_load=fa + a,
+            wprime=9.8 * factor * a * tau,
+            tau=tau,
+            alpha=1 / (factor * tau),
+        )
+
+    fa, a, tau = _fit_decay_weighted(t, f, np.ones((1, len(t))), taus)
+    res = {name: float(value[0]) for name, value in derived(fa, a, tau).items()}
+
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        seeds = np.random.SeedSequence(seed).spawn(workers)
+        sizes = [len(chunk) for chunk in np.array_split(np.arange(nboot), workers)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(_bootstrap_decay, [t]*workers, [f]*workers, [taus]*workers,
+                                  sizes, seeds))
+        boot = [np.concatenate(arrays) for arrays in zip(*parts)]
+    else:
+        boot = _bootstrap_decay(t, f, taus, nboot, seed)
+    # resamples whose tau ran off the grid have no decay to speak of
+    good = (boot[2] > taus[0]) & (boot[2] < taus[-1])
+    for name, values in derived(*boot).items():
+        values = values[good & np.isfinite(values)]
+        if len(values) > 1:
+            res['e_' + name] = float(np.std(values))
+            res['ci_' + name] = tuple(float(v) for v in np.percentile(values, [2.5, 97.5]))
+        else:
+            res['e_' + name] = np.nan
+            res['ci_' + name] = (np.nan, np.nan)
+
+    res['predicted_force'] = fa[0] + a[0] * np.exp(-(np.asarray(tmeans) - t0) / tau[0])
+    return res
@@ -0,0 +1,176 @@
+"""
+Re-analyse archives of recorded tests in parallel.
+
+Each file is analysed in a worker process and reduced to one row of
+results, so a file that can't be read or analysed only spoils its own row.
+"""
+import os
+import csv
+import glob
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .analysis import measure_mean_loads, critical_force, fit_decay
+from .session import Session, is_session_file
+
+# columns of the summary table
+fields = [
+    "file",
+    "reps",
+    "peak_load",
+    "critical_load",
+    "load_asymptote",
+    "wprime",
+    "anaerobic_score",
+    "fit_critical_load",
+    "e_fit_critical_load",
+    "fit_wprime",
+    "e_fit_wprime",
+    "tau",
+    "e_tau",
+    "error",
+]
+
+
+def find_sessions(patterns):
+    """
+    Session and text files matching a list of directories and glob patterns
+    """
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for ext in ("*.tdqs", "*.txt"):
+                paths.extend(glob.glob(os.path.join(pattern, ext)))
+        else:
+            paths.extend(glob.glob(pattern))
+    return sorted(set(paths))
+
+
+def analyse_file(path, load_time=7, rest_time=3, trigger_level=3, nboot=1000):
+    """
+    One row of the summary table for a session or legacy text file.
+
+    Session files use the work and rest times in their header, and their
+    stored work intervals if found with trigger_level. Errors are
+    caught and reported in the ``error`` column. trigger_level may be
+    "auto" to estimate it for each file. The decay fit uses nboot
+    bootstrap resamples, seeded from the data so reruns agree.
+    """
+    row = dict(file=path)
+    try:
+        reps = None
+        if is_session_file(path):
+            session = Session(path)
+            t, f = session.times, session.weights
+            load_time = session.work_time or load_time
+            rest_time = session.rest_time or rest_time
+            reps = session.reps(trigger_level)
+        else:
+            t, f = np.loadtxt(path).T
+        tmeans, durations, _, fmeans, e_fmeans = measure_mean_loads(
+            t, f, trigger_level, reps=reps
+        )
+        if len(fmeans) == 0:
+            raise ValueError("no reps found")
+        with np.errstate(all="ignore"):
+            res = critical_force(tmeans, durations, fmeans, e_fmeans, load_time, rest_time)
+            seed = zlib.crc32(np.ascontiguousarray(f).tobytes())
+            fit = fit_decay(tmeans, fmeans, load_time, rest_time, nboot, seed=seed)
+        row["reps"] = res["reps"]
+        for key in fields[2:7]:
+            row[key] = float(res[key])
+        for key in fields[7:-1]:
+            row[key] = fit[key.replace("fit_", "")]
+    except Exception as err:
+        row["error"] = f"{type(err).__name__}: {err}"
+    return row
+
+
+# caches opened by this process, so each keeps its running size total
+_caches = {}
+
+
+def _open_cache(path):
+    if path not in _caches:
+        # imported here as the cache hashes this module
+        from .cache import AnalysisCache
+
+        _caches[path] = AnalysisCache(path)
+    return _caches[path]
+
+
+def _analyse_file(args):
+    path, load_time, rest_time, trigger_level, nboot, cache_path = args
+    if cache_path is None:
+        return analyse_file(path, load_time, rest_time, trigger_level, nboot)
+    cache = _open_cache(cache_path)
+    params = dict(
+        load_time=load_time, rest_time=rest_time, trigger_level=trigger_level, nboot=nboot
+    )
+    try:
+        key = cache.key(path, **params)
+    except OSError as err:
+        return dict(file=path, error=f"{type(err).__name__}: {err}")
+    row = cache.get(key)
+    if row is None:
+        row = analyse_file(path, **params)
+        # failures might be passing, so only keep results
+        if not row.get("error"):
+            cache.put(key, row)
+    # the same data may be cached under another name
+    return dict(row, file=path)
+
+
+def reanalyse(
+    paths,
+    load_time=7,
+    rest_time=3,
+    workers=None,
+    chunksize=None,
+    trigger_level=3,
+    nboot=1000,
+    cache_path=None,
+):
+    """
+    Analyse files in a process pool, yielding result rows in order.
+
+    Parameters
+    ----------
+    paths: list of str
+        Files to analyse
+    load_time, rest_time: float
+        Work and rest times (s) for files that don't record them
+    workers: int, optional
+        Number of worker processes. Default is one per CPU.
+    chunksize: int, optional
+        Files sent to a worker at a time. By default the files are split
+        into about four chunks per worker, which keeps the pool busy without
+        paying for a round trip per file.
+    trigger_level: float or "auto"
+        Load (kg) separating work from rest
+    nboot: int
+        Bootstrap resamples for the decay fit of each file
+    cache_path: str, optional
+        Directory of an `AnalysisCache` to reuse results from
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, len(paths) // (4 * workers))
+    jobs = [(path, load_time, rest_time, trigger_level, nboot, cache_path) for path in paths]
+    if workers == 1:
+        yield from map(_analyse_file, jobs)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(_analyse_file, jobs, chunksize=chunksize)
+
+
+def write_summary(rows, fileobj):
+    """
+    Write result rows as CSV
+    """
+    writer = csv.DictWriter(fileobj, fieldnames=fields)
+    writer.writeheader()
+    writer.writerows(rows)
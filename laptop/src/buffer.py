@@ -0,0 +1,122 @@
+import numpy as np
+
+
+class SampleBuffer:
+    def __init__(self, capacity=None, initial_size=4096, dtype=np.float32):
+        """
+        Array backed store for (time, weight) samples.
+
+        Samples are appended into preallocated arrays. When ``capacity`` is
+        None the arrays double in size whenever they fill up, so the whole
+        session is kept. Otherwise the buffer behaves as a ring buffer which
+        keeps the most recent ``capacity`` samples; the storage is twice the
+        capacity, so that old samples are only moved back to the start of
+        the arrays once every ``capacity`` appends and all views stay
+        contiguous.
+
+        A SampleBuffer can be the parent of a `TindeqProgressor`, which
+        makes it a capture sink costing one array copy per packet, fast
+        enough for the high rate RFD modes.
+
+        Views returned by `unread` and `session` share memory with the
+        buffer. They are valid until the next call to `append` or `extend`,
+        so copy them if you need to keep them longer.
+
+        Parameters
+        ----------
+        capacity: int or None
+            Maximum number of samples to keep. None for unbounded.
+        initial_size: int
+            Number of samples to allocate room for up front
+        dtype: np.dtype
+            Data type of the weights. Times are always float64.
+        """
+        if capacity is not None:
+            initial_size = min(initial_size, 2 * capacity)
+        self.capacity = capacity
+        self._times = np.empty(max(initial_size, 1), dtype=np.float64)
+        self._weights = np.empty(max(initial_size, 1), dtype=dtype)
+        # storage indices of oldest kept, first unread and one past newest sample
+        self._start = 0
+        self._read = 0
+        self._end = 0
+        # number of samples ever added
+        self.total = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def clear(self):
+        self._start = self._read = self._end = 0
+
+    def append(self, time, weight):
+        if self._end == len(self._times):
+            self._make_room(1)
+        self._times[self._end] = time
+        self._weights[self._end] = weight
+        self._end += 1
+        self.total += 1
+        self._trim()
+
+    def extend(self, times, weights):
+        n = len(times)
+        self.total += n
+        if self.capacity is not None and n > self.capacity:
+            times = times[-self.capacity:]
+            weights = weights[-self.capacity:]
+            n = self.capacity
+        if self._end + n > len(self._times):
+            self._make_room(n)
+        self._times[self._end : self._end + n] = times
+        self._weights[self._end : self._end + n] = weights
+        self._end += n
+        self._trim()
+
+    def log_force_samples(self, times, weights):
+        self.extend(times, weights)
+
+    def log_rfd_samples(self, times, values):
+        self.extend(times, values)
+
+    def unread(self):
+        """
+        Views of all samples added since the last call to `unread`
+        """
+        start, self._read = self._read, self._end
+        return self._times[start : self._end], self._weights[start : self._end]
+
+    def session(self):
+        """
+        Views of all the samples held in the buffer
+        """
+        return (
+            self._times[self._start : self._end],
+            self._weights[self._start : self._end],
+        )
+
+    def _trim(self):
+        if self.capacity is not None and len(self) > self.capacity:
+            self._start = self._end - self.capacity
+            self._read = max(self._read, self._start)
+
+    def _make_room(self, n):
+        keep = len(self)
+        if self.capacity is not None:
+            keep = min(keep, self.capacity - n)
+        first = self._end - keep
+        size = len(self._times)
+        if self.capacity is None or size < 2 * self.capacity:
+            size = max(2 * size, keep + n)
+            if self.capacity is not None:
+                size = min(size, 2 * self.capacity)
+            times = np.empty(size, dtype=self._times.dtype)
+            weights = np.empty(size, dtype=self._weights.dtype)
+        else:
+            # storage is at full size, move samples we keep back to the start
+            times, weights = self._times, self._weights
+        times[:keep] = self._times[first : self._end]
+        weights[:keep] = self._weights[first : self._end]
+        self._times, self._weights = times, weights
+        self._read = max(self._read - first, 0)
+        self._start = 0
+        self._end = keep
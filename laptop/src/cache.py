@@ -0,0 +1,154 @@
+"""
+Persistent cache of analysis results.
+
+Results are stored one pickle per entry, named by a SHA-256 key made from
+the contents of the session file, the analysis parameters and the source
+of the loading and analysis code. Changing any of them gives a new key, so stale
+results are never returned; they just age out of the cache.
+"""
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+import functools
+
+from . import analysis, batch, session
+
+
+@functools.lru_cache(maxsize=None)
+def code_version():
+    """
+    Hash of the source of the modules whose results are cached
+    """
+    digest = hashlib.sha256()
+    for module in (analysis, batch, session):
+        with open(module.__file__, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    default_path = os.path.join(os.path.expanduser("~"), ".pytindeq_cache")
+
+    def __init__(self, path=default_path, max_bytes=256 * 1024**2):
+        """
+        Cache of analysis results, keyed by file contents and parameters.
+
+        The least recently used entries are removed to keep the cache under
+        ``max_bytes``. The size is scanned once and then kept as a running
+        total, so the directory is only scanned again when the total goes
+        over. Writes are atomic, so processes can share a cache; each one's
+        total is corrected whenever it scans.
+
+        Parameters
+        ----------
+        path: str
+            Directory to keep the cache in. Created if needed.
+        max_bytes: int
+            Maximum total size of the cached results
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.version = code_version()
+        self.hits = 0
+        self.misses = 0
+        # running total of the entry sizes, scanned on the first put
+        self._size = None
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, filename, **params):
+        """
+        Key for the results of analysing ``filename`` with ``params``
+        """
+        digest = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode("utf-8"))
+        digest.update(self.version.encode("ascii"))
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + ".pickle")
+
+    def get(self, key, default=None):
+        entry = self._entry(key)
+        try:
+            with open(entry, "rb") as f:
+                value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            self.misses += 1
+            return default
+        # the modification time is the last use, for eviction
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self._size is None:
+            self._size = self.size()
+        entry = self._entry(key)
+        try:
+            # an entry written by another process is replaced
+            self._size -= os.stat(entry).st_size
+        except OSError:
+            pass
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                self._size += f.tell()
+            os.replace(tmp, entry)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if self._size > self.max_bytes:
+            # leave some room, so a full cache isn't scanned on every put
+            self.evict(0.9 * self.max_bytes)
+
+    def cached(self, func, filename, **params):
+        """
+        func(filename, **params), from the cache if possible
+        """
+        key = self.key(filename, **params)
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = func(filename, **params)
+            self.put(key, value)
+        return value
+
+    def size(self):
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def _entries(self):
+        return [e for e in os.scandir(self.path) if e.name.endswith(".pickle")]
+
+    def evict(self, max_bytes=None):
+        """
+        Remove least recently used entries until the cache fits in max_bytes
+        (default: the cache's limit)
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in self._entries()]
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+
+    def clear(self):
+        for entry in self._entries():
+            os.remove(entry.path)
+        self._size = 0
@@ -0,0 +1,181 @@
+"""
+Raw capture files: every notification frame, as received, with its arrival time.
+
+A capture starts with a header (magic bytes, the wall clock time the
+capture was opened and the soft tare in kg, NaN if unknown), followed by one
+record per frame:
+
+    <d  arrival time, time.monotonic() seconds
+    <H  frame length in bytes
+        the frame itself
+
+Frames are only ever appended, so a capture cut short by a crash is still
+readable up to its last complete record. Version 1 captures, without the
+tare, can still be read.
+"""
+import time
+import struct
+import asyncio
+
+import numpy as np
+
+from .tindeq import TindeqProgressor, DeviceCache
+
+MAGIC = b"TDQCAP02"
+header_struct = struct.Struct("<8sdd")
+v1_magic = b"TDQCAP01"
+v1_header_struct = struct.Struct("<8sd")
+record_struct = struct.Struct("<dH")
+
+
+class CaptureWriter:
+    def __init__(self, path, tare=None, flush_interval=1.0, buffer_size=65536):
+        """
+        Write notification frames to a capture file as they arrive.
+
+        Writes are buffered, and the buffer is flushed to the OS at least
+        every ``flush_interval`` seconds, so little is lost if the app dies.
+
+        Use by setting the ``recorder`` attribute of a `TindeqProgressor`:
+
+            >>> tindeq.recorder = CaptureWriter("session.tdqcap")
+
+        Parameters
+        ----------
+        path: str
+            File to write. An existing file is overwritten.
+        tare: float, optional
+            Soft tare (kg) the Progressor was using, needed to replay the
+            frames as the weights that were logged
+        flush_interval: float
+            Maximum time (s) frames sit in the write buffer
+        buffer_size: int
+            Size of the write buffer in bytes
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.frames = 0
+        self._file = open(path, "wb", buffering=buffer_size)
+        tare = np.nan if tare is None else tare
+        self._file.write(header_struct.pack(MAGIC, time.time(), tare))
+        self._last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excinfo):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def write(self, frame, arrival=None):
+        if arrival is None:
+            arrival = time.monotonic()
+        self._file.write(record_struct.pack(arrival, len(frame)))
+        self._file.write(frame)
+        self.frames += 1
+        if arrival - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._file.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class CaptureReader:
+    def __init__(self, path):
+        """
+        Memory-mapped view of a capture file.
+
+        Iterating gives (arrival time, frame) pairs, where each frame is a
+        view into the mapped file. A truncated final record is ignored.
+        ``tare`` is the recorded soft tare (kg), or None if unknown.
+        """
+        self.path = path
+        self._data = np.memmap(path, dtype=np.uint8, mode="r")
+        magic = bytes(self._data[: len(MAGIC)])
+        if magic == MAGIC:
+            _, self.started, tare = header_struct.unpack_from(self._data)
+            self._header_size = header_struct.size
+        elif magic == v1_magic:
+            _, self.started = v1_header_struct.unpack_from(self._data)
+            tare = np.nan
+            self._header_size = v1_header_struct.size
+        else:
+            raise ValueError(f"{path} is not a capture file")
+        self.tare = None if np.isnan(tare) else tare
+        self.arrivals, self.offsets, self.lengths = self._index()
+
+    def _index(self):
+        arrivals, offsets, lengths = [], [], []
+        pos = self._header_size
+        end = len(self._data)
+        while pos + record_struct.size <= end:
+            arrival, length = record_struct.unpack_from(self._data, pos)
+            pos += record_struct.size
+            if pos + length > end:
+                break
+            arrivals.append(arrival)
+            offsets.append(pos)
+            lengths.append(length)
+            pos += length
+        return np.array(arrivals), np.array(offsets, dtype=np.int64), np.array(lengths)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        for arrival, offset, length in zip(self.arrivals, self.offsets, self.lengths):
+            yield arrival, self._data[offset : offset + length]
+
+    async def replay(self, target, realtime=False, speed=1.0, tare=None):
+        """
+        Feed the captured frames through a `TindeqProgressor`.
+
+        Each frame is handled as if it arrived at its recorded arrival time,
+        so the progressor's clock maps sample times the same way as during
+        the capture.
+
+        Parameters
+        ----------
+        target: TindeqProgressor or object
+            A TindeqProgressor, or a sink to be the parent of a new,
+            unconnected one
+        realtime: bool
+            If True, reproduce the original gaps between frames (divided by
+            ``speed``). Otherwise replay as fast as possible.
+        speed: float
+            Speed up factor for real time replay
+        tare: float, optional
+            Soft tare (kg) to remove from the weights. By default, the one
+            recorded in the capture, if any.
+
+        Returns
+        -------
+        tindeq: TindeqProgressor
+            The progressor the frames were fed through
+        """
+        if isinstance(target, TindeqProgressor):
+            tindeq = target
+        else:
+            tindeq = TindeqProgressor(target, DeviceCache(path=None))
+        if tare is None:
+            tare = self.tare
+        if tare is not None:
+            tindeq._tare_value = tare
+        if len(self) == 0:
+            return tindeq
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for arrival, frame in self:
+            if realtime:
+                due = start + (arrival - self.arrivals[0]) / speed
+                await asyncio.sleep(max(due - loop.time(), 0))
+            tindeq._notify_handler(None, frame, arrival)
+        return tindeq
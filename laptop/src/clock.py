@@ -0,0 +1,116 @@
+import time
+
+import numpy as np
+
+
+class DeviceClock:
+    def __init__(self, window=512, refit_interval=5.0, envelope_size=8):
+        """
+        Continuous device timestamps, and their mapping onto host time.
+
+        The Progressor stamps samples with a signed 32-bit microsecond
+        counter, which wraps after about 71 minutes. `unwrap` turns these
+        into a continuous count.
+
+        Host time is ``time.monotonic()``. Each packet gives the offset
+        between the arrival time and the device time of its last sample.
+        That offset is the true clock offset plus a transmission delay which
+        is never negative, so we fit a straight line (offset and drift)
+        to the lower envelope of recent offsets: the minimum over each run
+        of ``envelope_size`` packets.
+
+        Parameters
+        ----------
+        window: int
+            Number of recent packets used in the fit
+        refit_interval: float
+            Refit the mapping at most this often (s of device time)
+        envelope_size: int
+            Number of packets in each run when taking the lower envelope
+        """
+        self.window = window
+        self.refit_interval = refit_interval
+        self.envelope_size = envelope_size
+        self.reset()
+
+    def reset(self):
+        self._last_raw = None
+        self._wrap_offset = 0
+        # ring buffer of (device time, offset) for recent packets
+        self._samples = np.zeros((self.window, 2))
+        self._count = 0
+        self._fit_time = None
+        self.offset = None
+        self.drift = 0.0
+        self._t_ref = 0.0
+
+    def unwrap(self, useconds):
+        """
+        Device counter values to continuous microseconds (int64)
+        """
+        raw = np.asarray(useconds, dtype=np.int64)
+        if raw.size == 0:
+            return raw
+        first, last = int(raw[0]), int(raw[-1])
+        previous = first if self._last_raw is None else self._last_raw
+        self._last_raw = last
+        # a packet spans far less than a wrap, so a wrap inside it puts the
+        # last sample before the first
+        if first - previous >= -(2**31) and last >= first:
+            return raw + self._wrap_offset if self._wrap_offset else raw
+        steps = np.diff(raw, prepend=previous)
+        wraps = self._wrap_offset + np.cumsum(steps < -(2**31)) * 2**32
+        self._wrap_offset = int(wraps[-1])
+        return raw + wraps
+
+    def observe(self, device_time, host_time=None):
+        """
+        Record that a packet whose last sample was taken at ``device_time``
+        (s) arrived at ``host_time`` (default: now).
+        """
+        if host_time is None:
+            host_time = time.monotonic()
+        self._samples[self._count % self.window] = device_time, host_time - device_time
+        self._count += 1
+        if self._fit_time is None or device_time - self._fit_time >= self.refit_interval:
+            self._fit_time = device_time
+            self._fit()
+
+    def _fit(self):
+        if self._count <= self.window:
+            samples = self._samples[: self._count]
+        else:
+            # oldest first
+            samples = np.roll(self._samples, -(self._count % self.window), axis=0)
+        device, offset = samples.T
+        n = len(offset) // self.envelope_size
+        if n < 2:
+            # not enough for a drift estimate yet
+            self._t_ref = device[np.argmin(offset)]
+            self.offset = offset.min()
+            self.drift = 0.0
+            return
+        runs = offset[: n * self.envelope_size].reshape(n, self.envelope_size)
+        idx = np.argmin(runs, axis=1) + np.arange(n) * self.envelope_size
+        self._t_ref = device[idx].mean()
+        # straight line fit about the mean time, where the terms separate
+        x = device[idx] - self._t_ref
+        y = offset[idx]
+        self.offset = y.mean()
+        self.drift = np.dot(x, y - self.offset) / np.dot(x, x)
+
+    def to_host(self, device_time):
+        """
+        Device time (s) to host monotonic time (s)
+        """
+        if self.offset is None:
+            raise RuntimeError("no packets received yet")
+        return device_time + self.offset + self.drift * (device_time - self._t_ref)
+
+    def to_device(self, host_time):
+        """
+        Host monotonic time (s) to device time (s)
+        """
+        if self.offset is None:
+            raise RuntimeError("no packets received yet")
+        return (host_time - self.offset + self.drift * self._t_ref) / (1 + self.drift)
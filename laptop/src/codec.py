@@ -0,0 +1,279 @@
+"""
+Compressed archive format for recorded sessions.
+
+Samples are stored as the Progressor sends them: integer microsecond
+timestamps (times are rounded to the nearest microsecond) and float32
+weights. Timestamps are delta-of-delta encoded, which is almost always zero
+at a steady sample rate. Weights are either stored exactly, as deltas of
+their float32 bit patterns, or quantised to a fixed step and delta encoded.
+Both streams are written as zigzag varints and finally deflated.
+
+An archive is a header followed by independent chunks, so it can be
+written and read a chunk at a time:
+
+    8 bytes   magic, b"TDQZIP01"
+    <dBI      quantisation step (0 for exact), zlib level, metadata length
+              JSON metadata
+    chunks:
+    <III      number of samples, time stream length, weight stream length
+              time stream
+              weight stream
+"""
+import io
+import json
+import mmap
+import zlib
+import struct
+
+import numpy as np
+
+from .session import Session, save_session
+
+MAGIC = b"TDQZIP01"
+header_struct = struct.Struct("<8sdBI")
+chunk_struct = struct.Struct("<III")
+
+
+def zigzag(x):
+    x = np.asarray(x, dtype=np.int64)
+    return ((x << 1) ^ (x >> 63)).view(np.uint64)
+
+
+def unzigzag(u):
+    u = np.asarray(u, dtype=np.uint64)
+    return (u >> np.uint64(1)).view(np.int64) ^ -(u & np.uint64(1)).view(np.int64)
+
+
+def varint_encode(u):
+    """
+    LEB128 encode an array of unsigned integers, without a Python loop
+    """
+    u = np.asarray(u, dtype=np.uint64)
+    if u.size == 0:
+        return b""
+    nbytes = np.ones(len(u), dtype=np.int64)
+    for k in range(1, 10):
+        nbytes += u >= np.uint64(1 << (7 * k))
+    starts = np.cumsum(nbytes) - nbytes
+    owner = np.repeat(np.arange(len(u)), nbytes)
+    pos = np.arange(nbytes.sum()) - starts[owner]
+    out = (u[owner] >> (7 * pos).astype(np.uint64)) & np.uint64(0x7F)
+    out |= np.where(pos < nbytes[owner] - 1, np.uint64(0x80), np.uint64(0))
+    return out.astype(np.uint8).tobytes()
+
+
+def varint_decode(buf):
+    """
+    Decode a buffer of LEB128 varints into an array of uint64
+    """
+    b = np.frombuffer(buf, dtype=np.uint8)
+    if b.size == 0:
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(b < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    b = b[: ends[-1] + 1]
+    owner = np.repeat(np.arange(len(starts)), ends - starts + 1)
+    pos = np.arange(len(b)) - starts[owner]
+    groups = (b & 0x7F).astype(np.uint64) << (7 * pos).astype(np.uint64)
+    # the 7 bit groups don't overlap, so adding them is the same as or-ing
+    return np.add.reduceat(groups, starts)
+
+
+def _delta(x):
+    return np.diff(x, prepend=np.zeros(1, dtype=x.dtype))
+
+
+def encode_chunk(times, weights, quantum=None, level=6):
+    """
+    Encode times (s) and weights (kg) as one chunk
+    """
+    useconds = np.round(np.asarray(times, dtype=np.float64) * 1.0e6).astype(np.int64)
+    tstream = varint_encode(zigzag(_delta(_delta(useconds))))
+    if quantum:
+        ints = np.round(np.asarray(weights, dtype=np.float64) / quantum).astype(np.int64)
+    else:
+        ints = np.asarray(weights, dtype=np.float32).view(np.int32).astype(np.int64)
+    wstream = varint_encode(zigzag(_delta(ints)))
+    if level:
+        tstream = zlib.compress(tstream, level)
+        wstream = zlib.compress(wstream, level)
+    return chunk_struct.pack(len(useconds), len(tstream), len(wstream)) + tstream + wstream
+
+
+def decode_chunk(buf, offset=0, quantum=None, level=6):
+    """
+    Decode the chunk at ``offset`` in ``buf``.
+
+    Returns times (s), weights (kg) and the offset of the next chunk.
+    """
+    n, tlen, wlen = chunk_struct.unpack_from(buf, offset)
+    offset += chunk_struct.size
+    tstream = buf[offset : offset + tlen]
+    wstream = buf[offset + tlen : offset + tlen + wlen]
+    if level:
+        tstream = zlib.decompress(tstream)
+        wstream = zlib.decompress(wstream)
+    useconds = np.cumsum(np.cumsum(unzigzag(varint_decode(tstream))))
+    ints = np.cumsum(unzigzag(varint_decode(wstream)))
+    if quantum:
+        weights = (ints * quantum).astype(np.float32)
+    else:
+        weights = ints.astype(np.int32).view(np.float32)
+    if len(useconds) != n or len(weights) != n:
+        raise ValueError("corrupt chunk")
+    return useconds / 1.0e6, weights, offset + tlen + wlen
+
+
+class ArchiveWriter:
+    def __init__(self, fileobj, quantum=None, level=6, chunk_size=8192, metadata=None):
+        """
+        Write samples to a compressed archive, a chunk at a time.
+
+        Parameters
+        ----------
+        fileobj: file
+            Binary file object to write to
+        quantum: float or None
+            Quantisation step for weights (kg). None stores them exactly.
+        level: int
+            zlib compression level, 0 to skip deflating
+        chunk_size: int
+            Number of samples per chunk
+        metadata: dict, optional
+            JSON serialisable metadata, e.g. a session header
+        """
+        self.fileobj = fileobj
+        self.quantum = quantum
+        self.level = level
+        self.chunk_size = chunk_size
+        self._times = []
+        self._weights = []
+        self._pending = 0
+        meta = json.dumps(metadata or {}).encode("utf-8")
+        fileobj.write(header_struct.pack(MAGIC, quantum or 0.0, level, len(meta)))
+        fileobj.write(meta)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excinfo):
+        self.close()
+
+    def write(self, times, weights):
+        self._times.append(np.asarray(times, dtype=np.float64))
+        self._weights.append(np.asarray(weights, dtype=np.float32))
+        self._pending += len(times)
+        if self._pending >= self.chunk_size:
+            self._write_chunks(final=False)
+
+    def close(self):
+        self._write_chunks(final=True)
+
+    def _write_chunks(self, final):
+        if not self._pending:
+            return
+        times = np.concatenate(self._times)
+        weights = np.concatenate(self._weights)
+        nfull = len(times) // self.chunk_size * self.chunk_size
+        stop = len(times) if final else nfull
+        for start in range(0, stop, self.chunk_size):
+            end = min(start + self.chunk_size, stop)
+            self.fileobj.write(
+                encode_chunk(times[start:end], weights[start:end], self.quantum, self.level)
+            )
+        self._times, self._weights = [times[stop:]], [weights[stop:]]
+        self._pending = len(times) - stop
+
+
+class ArchiveReader:
+    def __init__(self, buf):
+        """
+        Read a compressed archive from a bytes-like object, such as a
+        memory-mapped file.
+
+        Iterate to get (times, weights) a chunk at a time, or use `read`
+        for everything at once.
+        """
+        self.buf = buf
+        magic, quantum, self.level, meta_len = header_struct.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError("not a session archive")
+        self.quantum = quantum or None
+        start = header_struct.size
+        self.metadata = json.loads(bytes(buf[start : start + meta_len]))
+        self._first_chunk = start + meta_len
+
+    def __iter__(self):
+        offset = self._first_chunk
+        while offset < len(self.buf):
+            times, weights, offset = decode_chunk(self.buf, offset, self.quantum, self.level)
+            yield times, weights
+
+    def read(self):
+        chunks = list(self)
+        if not chunks:
+            return np.zeros(0), np.zeros(0, dtype=np.float32)
+        times, weights = zip(*chunks)
+        return np.concatenate(times), np.concatenate(weights)
+
+
+def encode(times, weights, quantum=None, level=6, chunk_size=8192, metadata=None):
+    out = io.BytesIO()
+    with ArchiveWriter(out, quantum, level, chunk_size, metadata) as writer:
+        writer.write(times, weights)
+    return out.getvalue()
+
+
+def decode(buf):
+    return ArchiveReader(buf).read()
+
+
+def archive_session(session_path, archive_path, quantum=None, level=6):
+    """
+    Compress a session file, keeping its header as metadata
+    """
+    session = Session(session_path)
+    header = {k: v for k, v in session.header.items() if k != "arrays"}
+    with open(archive_path, "wb") as f:
+        with ArchiveWriter(f, quantum, level, metadata=header) as writer:
+            writer.write(session.times, session.weights)
+
+
+def restore_session(archive_path, session_path):
+    """
+    Turn an archive made by `archive_session` back into a session file.
+
+    The archive is memory-mapped and decoded a chunk at a time into the
+    output arrays, and the original header is kept, including when the
+    test was recorded.
+    """
+    with open(archive_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        reader = ArchiveReader(buf)
+        header = dict(reader.metadata)
+        if "nsamples" in header:
+            times = np.empty(header["nsamples"])
+            weights = np.empty(header["nsamples"], dtype=np.float32)
+            start = 0
+            for chunk_times, chunk_weights in reader:
+                end = start + len(chunk_times)
+                times[start:end] = chunk_times
+                weights[start:end] = chunk_weights
+                start = end
+            if start != len(times):
+                raise ValueError("archive has the wrong number of samples")
+        else:
+            times, weights = reader.read()
+    save_session(
+        session_path,
+        times,
+        weights,
+        header.get("work_time"),
+        header.get("rest_time"),
+        tare=header.get("tare"),
+        firmware=header.get("firmware"),
+        battery_mv=header.get("battery_mv"),
+        trigger_level=header.get("trigger_level", 3),
+        created=header.get("created"),
+        auto_trigger=header.get("auto_trigger"),
+        **header.get("metadata", {}),
+    )
@@ -0,0 +1,161 @@
+import time
+import asyncio
+import collections
+
+import numpy as np
+
+
+class StreamMetrics:
+    # edges of the inter-sample gap histogram, in ms
+    gap_bins = np.array([0, 5, 10, 15, 20, 30, 50, 100, 200, 500, 1000, np.inf])
+
+    def __init__(self, gap_factor=2.5, latency_window=2048, batch_packets=256):
+        """
+        Health counters for the notifications from one Progressor.
+
+        Tracks notification and sample rates (weight and RFD), samples per packet, a
+        histogram of the gaps between sample timestamps, timestamp
+        discontinuities (most likely lost packets), the time spent in the
+        notification callback and low power warnings.
+
+        Recording a packet only counts it and keeps its timestamps. The gap
+        statistics are worked out for a batch of packets at a time, and
+        when a snapshot is taken, to keep the notification callback cheap.
+
+        Parameters
+        ----------
+        gap_factor: float
+            A gap longer than this many nominal sample intervals counts
+            as a discontinuity
+        latency_window: int
+            Number of recent callback durations kept for percentiles
+        batch_packets: int
+            Number of packets whose timestamps are processed together
+        """
+        self.gap_factor = gap_factor
+        self.latency_window = latency_window
+        self.batch_packets = batch_packets
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.notifications = 0
+        self.weight_packets = 0
+        self.rfd_packets = 0
+        self.cmd_responses = 0
+        self.low_power_events = 0
+        self.unknown_packets = 0
+        self.samples = 0
+        self.discontinuities = 0
+        self.samples_lost = 0
+        self.gap_counts = np.zeros(len(self.gap_bins) - 1, dtype=np.int64)
+        self.sample_interval = None
+        self._last_time = None
+        self._packets = []
+        self._durations = collections.deque(maxlen=self.latency_window)
+
+    def record_notification(self, kind, response_codes):
+        self.notifications += 1
+        if kind == response_codes["weight_measure"]:
+            self.weight_packets += 1
+        elif kind in (response_codes["rfd_peak"], response_codes["rfd_peak_series"]):
+            self.rfd_packets += 1
+        elif kind == response_codes["cmd_resp"]:
+            self.cmd_responses += 1
+        elif kind == response_codes["low_pwr"]:
+            self.low_power_events += 1
+        else:
+            self.unknown_packets += 1
+
+    def record_samples(self, times):
+        """
+        Count the samples in one packet, given their timestamps (s)
+        """
+        n = len(times)
+        if n == 0:
+            return
+        self.samples += n
+        self._packets.append(times)
+        if len(self._packets) >= self.batch_packets:
+            self._process_packets()
+
+    def _process_packets(self):
+        """
+        Update the interval estimate and gap statistics from recent packets
+        """
+        if not self._packets:
+            return
+        sizes = np.array([len(times) for times in self._packets])
+        times = np.concatenate(self._packets)
+        self._packets = []
+        # gaps[i] is the gap before times[i]; the first is from the last batch
+        continued = self._last_time is not None
+        gaps = np.diff(times, prepend=self._last_time if continued else times[0])
+        self._last_time = times[-1]
+        starts = np.cumsum(sizes) - sizes
+        inside = np.ones(len(times), dtype=bool)
+        inside[starts] = False
+        if inside.any():
+            # nominal interval from gaps inside packets, which can't hide a loss
+            interval = np.median(gaps[inside])
+            if self.sample_interval is None:
+                self.sample_interval = interval
+            else:
+                self.sample_interval += 0.25 * (interval - self.sample_interval)
+        if not continued:
+            gaps = gaps[1:]
+        bins = np.searchsorted(self.gap_bins, 1.0e3 * gaps, side="right") - 1
+        self.gap_counts += np.bincount(
+            np.clip(bins, 0, len(self.gap_counts) - 1), minlength=len(self.gap_counts)
+        )
+        if self.sample_interval:
+            late = gaps > self.gap_factor * self.sample_interval
+            if late.any():
+                self.discontinuities += int(late.sum())
+                missing = np.round(gaps[late] / self.sample_interval) - 1
+                self.samples_lost += int(missing.sum())
+
+    def record_callback(self, duration):
+        self._durations.append(duration)
+
+    def snapshot(self):
+        """
+        Current metrics as a plain dict
+        """
+        self._process_packets()
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        durations = np.array(self._durations) * 1.0e6
+        if len(durations):
+            p50, p90, p99 = np.percentile(durations, [50, 90, 99])
+            callback = dict(p50=p50, p90=p90, p99=p99, max=durations.max())
+        else:
+            callback = dict(p50=np.nan, p90=np.nan, p99=np.nan, max=np.nan)
+        return dict(
+            elapsed=elapsed,
+            notifications=self.notifications,
+            notifications_per_s=self.notifications / elapsed,
+            samples=self.samples,
+            samples_per_s=self.samples / elapsed,
+            samples_per_packet=self.samples
+            / max(self.weight_packets + self.rfd_packets, 1),
+            sample_interval_ms=(
+                np.nan if self.sample_interval is None else 1.0e3 * self.sample_interval
+            ),
+            gap_histogram_ms=dict(
+                edges=self.gap_bins.tolist(), counts=self.gap_counts.tolist()
+            ),
+            discontinuities=self.discontinuities,
+            samples_lost=self.samples_lost,
+            callback_us={k: float(v) for k, v in callback.items()},
+            cmd_responses=self.cmd_responses,
+            low_power_events=self.low_power_events,
+            unknown_packets=self.unknown_packets,
+        )
+
+    async def export(self, sink=print, interval=10.0):
+        """
+        Pass a snapshot to ``sink`` every ``interval`` seconds, until cancelled
+        """
+        while True:
+            await asyncio.sleep(interval)
+            sink(self.snapshot())
@@ -0,0 +1,331 @@
+"""
+Simulated Progressor, for running without a Bluetooth radio.
+
+`SimulatedClient` and `SimulatedScanner` stand in for bleak's
+`BleakClient` and `BleakScanner`. They talk to `SimulatedDevice` objects,
+which stream weight packets framed exactly like a real Progressor and answer
+its commands. Devices can run faster than real time, and can be told to drop
+packets, send bursts and send low power warnings.
+
+    >>> add_device(speed=10)
+    >>> tindeq = TindeqProgressor(parent, DeviceCache(path=None))
+    >>> use_simulator(tindeq)
+    >>> await tindeq.connect()
+"""
+import asyncio
+import struct
+from types import SimpleNamespace
+
+import numpy as np
+
+from .tindeq import TindeqProgressor
+
+# simulated devices, by address
+devices = {}
+
+
+def cft_profile(t, work_time=7, rest_time=3, peak=40.0, asymptote=18.0, tau=60.0):
+    """
+    Force (kg) during an all-out repeater test, with exponential fatigue
+    """
+    t = np.asarray(t)
+    working = (t % (work_time + rest_time)) < work_time
+    return np.where(working, asymptote + (peak - asymptote) * np.exp(-t / tau), 0.0)
+
+
+def synthetic_trace(
+    reps=24,
+    work_time=7,
+    rest_time=3,
+    peak=40.0,
+    asymptote=18.0,
+    tau=60.0,
+    noise=0.2,
+    sample_rate=80.0,
+    dropout=0.0,
+    samples_per_packet=8,
+    seed=None,
+):
+    """
+    Times (s) and weights (kg) of a whole repeater test, without a device.
+
+    Parameters
+    ----------
+    reps: int
+        Number of work/rest cycles
+    work_time, rest_time: float
+        Length of the work and rest intervals (s)
+    peak, asymptote, tau: float
+        Fatigue curve: force falls from peak towards asymptote (kg) with
+        time constant tau (s)
+    noise: float
+        Standard deviation of the noise on each sample (kg)
+    sample_rate: float
+        Samples per second
+    dropout: float
+        Fraction of packets lost, each of ``samples_per_packet`` samples
+    seed: int, optional
+        Seed for the noise and dropout
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(reps * (work_time + rest_time) * sample_rate)) / sample_rate
+    f = cft_profile(t, work_time, rest_time, peak, asymptote, tau)
+    if noise:
+        f = f + rng.normal(0, noise, len(t))
+    if dropout:
+        packet = np.arange(len(t)) // samples_per_packet
+        keep = rng.random(packet[-1] + 1) >= dropout
+        t, f = t[keep[packet]], f[keep[packet]]
+    return t, f.astype(np.float32)
+
+
+def weight_packet(weights, useconds, kind=TindeqProgressor.response_codes["weight_measure"]):
+    """
+    Frame samples as a weight measurement notification
+    """
+    samples = np.empty(len(weights), dtype=TindeqProgressor.sample_dtype)
+    samples["weight"] = weights
+    samples["useconds"] = useconds
+    payload = samples.tobytes()
+    return bytearray(struct.pack("<bb", kind, len(payload)) + payload)
+
+
+def response_packet(payload=b"", kind=TindeqProgressor.response_codes["cmd_resp"]):
+    """
+    Frame a payload as a command response notification
+    """
+    return bytearray(struct.pack("<bb", kind, len(payload)) + payload)
+
+
+class SimulatedDevice:
+    def __init__(
+        self,
+        name="Progressor_SIM",
+        address="SI:MU:LA:TE:D0:00",
+        sample_rate=80.0,
+        rfd_sample_rate=1000.0,
+        samples_per_packet=8,
+        speed=1.0,
+        profile=cft_profile,
+        noise=0.2,
+        drop_rate=0.0,
+        latency=0.01,
+        battery_mv=3900,
+        firmware="1.2.3-sim",
+        crash_log="",
+        seed=None,
+    ):
+        """
+        A fake Progressor.
+
+        Parameters
+        ----------
+        name, address: str
+            What the device advertises
+        sample_rate: float
+            Samples per second of device time
+        rfd_sample_rate: float
+            Samples per second of device time in the peak RFD modes
+        samples_per_packet: int
+            Number of samples in each weight notification (at most 15)
+        speed: float
+            How much faster than real time to run. Use ``float("inf")``
+            to send packets as fast as the event loop allows.
+        profile: callable
+            Maps device time (s) to force (kg)
+        noise: float
+            Standard deviation of gaussian noise added to the force (kg)
+        drop_rate: float
+            Probability that a weight packet is lost
+        latency: float
+            Delay (s of device time) before command responses arrive
+        battery_mv, firmware, crash_log:
+            Answers to GET_BATT_VLTG, GET_APP_VERSION and GET_ERR_INFO
+        seed: int
+            Seed for the noise and packet loss
+        """
+        self.name = name
+        self.address = address
+        self.sample_rate = sample_rate
+        self.rfd_sample_rate = rfd_sample_rate
+        self.samples_per_packet = samples_per_packet
+        self.speed = speed
+        self.profile = profile
+        self.noise = noise
+        self.drop_rate = drop_rate
+        self.latency = latency
+        self.battery_mv = battery_mv
+        self.firmware = firmware
+        self.crash_log = crash_log
+        self.rng = np.random.default_rng(seed)
+
+        self.handler = None
+        self.mode = TindeqProgressor.response_codes["weight_measure"]
+        self.device_time = 0.0
+        self.tare_offset = 0.0
+        self.sample_count = 0
+        self.packets_sent = 0
+        self.packets_dropped = 0
+        self._burst = 0
+        self._task = None
+
+    def low_power_warning(self):
+        self._notify(response_packet(kind=TindeqProgressor.response_codes["low_pwr"]))
+
+    def burst(self, npackets):
+        """
+        Send the next ``npackets`` weight packets back to back
+        """
+        self._burst += npackets
+
+    @property
+    def rate(self):
+        if self.mode == TindeqProgressor.response_codes["weight_measure"]:
+            return self.sample_rate
+        return self.rfd_sample_rate
+
+    def next_packet(self):
+        """
+        Build the next weight or RFD packet, advancing the device clock
+        """
+        t = self.device_time + np.arange(self.samples_per_packet) / self.rate
+        self.device_time += self.samples_per_packet / self.rate
+        self.sample_count += self.samples_per_packet
+        if self.mode == TindeqProgressor.response_codes["weight_measure"]:
+            values = self.profile(t) - self.tare_offset
+            if self.noise:
+                values = values + self.rng.normal(0, self.noise, len(t))
+        else:
+            # rate of force development, kg/s
+            dt = 1.0e-3
+            values = (self.profile(t + dt) - self.profile(t)) / dt
+        # device clock is a signed 32-bit microsecond counter
+        useconds = (np.round(t * 1e6).astype(np.int64) + 2**31) % 2**32 - 2**31
+        return weight_packet(values, useconds, kind=self.mode)
+
+    def handle_command(self, data):
+        cmd = data[0]
+        cmds = TindeqProgressor.cmds
+        if cmd == cmds["TARE_SCALE"]:
+            self.tare_offset = float(self.profile(self.device_time))
+            self._respond(b"")
+        elif cmd == cmds["START_WEIGHT_MEAS"]:
+            self.start(TindeqProgressor.response_codes["weight_measure"])
+        elif cmd == cmds["START_PEAK_RFD_MEAS"]:
+            self.start(TindeqProgressor.response_codes["rfd_peak"])
+        elif cmd == cmds["START_PEAK_RFD_MEAS_SERIES"]:
+            self.start(TindeqProgressor.response_codes["rfd_peak_series"])
+        elif cmd in (cmds["STOP_WEIGHT_MEAS"], cmds["SLEEP"]):
+            self.stop()
+        elif cmd == cmds["GET_BATT_VLTG"]:
+            self._respond(struct.pack("<I", self.battery_mv))
+        elif cmd == cmds["GET_APP_VERSION"]:
+            self._respond(self.firmware.encode("utf-8"))
+        elif cmd == cmds["GET_ERR_INFO"]:
+            self._respond(self.crash_log.encode("utf-8"))
+        elif cmd == cmds["CLR_ERR_INFO"]:
+            self.crash_log = ""
+
+    def start(self, mode=TindeqProgressor.response_codes["weight_measure"]):
+        self.mode = mode
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._stream())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _respond(self, payload):
+        loop = asyncio.get_running_loop()
+        loop.call_later(self.latency / self.speed, self._notify, response_packet(payload))
+
+    def _notify(self, packet):
+        if self.handler is not None:
+            self.handler(self, packet)
+
+    async def _stream(self):
+        loop = asyncio.get_running_loop()
+        due = loop.time()
+        while True:
+            interval = self.samples_per_packet / self.rate / self.speed
+            packet = self.next_packet()
+            if self.drop_rate and self.rng.random() < self.drop_rate:
+                self.packets_dropped += 1
+            else:
+                self.packets_sent += 1
+                self._notify(packet)
+            if self._burst > 0:
+                self._burst -= 1
+                due = loop.time()
+                continue
+            due += interval
+            await asyncio.sleep(max(due - loop.time(), 0))
+
+
+def add_device(**kwargs):
+    """
+    Create a `SimulatedDevice` and make it discoverable
+    """
+    device = SimulatedDevice(**kwargs)
+    devices[device.address] = device
+    return device
+
+
+def use_simulator(tindeq):
+    """
+    Point a `TindeqProgressor` at the simulated devices
+    """
+    tindeq.client_class = SimulatedClient
+    tindeq.scanner_class = SimulatedScanner
+    return tindeq
+
+
+class SimulatedScanner:
+    """
+    Drop-in for the parts of `bleak.BleakScanner` used by `TindeqProgressor`
+    """
+
+    async def discover(self, timeout=5.0, **kwargs):
+        return list(devices.values())
+
+    async def find_device_by_filter(self, filterfunc, timeout=10.0, **kwargs):
+        for device in devices.values():
+            if filterfunc(device, SimpleNamespace(local_name=device.name)):
+                return device
+        return None
+
+
+class SimulatedClient:
+    """
+    Drop-in for the parts of `bleak.BleakClient` used by `TindeqProgressor`
+    """
+
+    def __init__(self, address_or_device, **kwargs):
+        address = getattr(address_or_device, "address", address_or_device)
+        self.device = devices.get(address)
+        self.is_connected = False
+
+    async def connect(self, **kwargs):
+        if self.device is None:
+            raise RuntimeError("simulated device not found")
+        self.is_connected = True
+        return True
+
+    async def disconnect(self):
+        if self.device is not None:
+            self.device.stop()
+            self.device.handler = None
+        self.is_connected = False
+        return True
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        self.device.handler = callback
+
+    async def stop_notify(self, char_specifier):
+        self.device.handler = None
+
+    async def write_gatt_char(self, char_specifier, data, response=None):
+        if not self.is_connected:
+            raise RuntimeError("not connected")
+        self.device.handle_command(bytes(data))
@@ -0,0 +1,135 @@
+import asyncio
+import collections
+
+import numpy as np
+
+
+class SampleStream:
+    policies = ("block", "drop-oldest", "coalesce")
+
+    def __init__(self, maxsize=64, overflow="block", on_close=None, max_backlog=1024):
+        """
+        Bounded queue of sample batches, consumed with ``async for``.
+
+        Batches are put on the queue from the notification handler, which
+        must never wait, and taken off by a consumer running at its own pace.
+        What happens when the queue is full is set by ``overflow``:
+
+        block
+            Extra batches are held back in a backlog and only enter the
+            queue as the consumer makes room. Once the backlog holds
+            ``max_backlog`` batches, new batches are dropped and counted.
+        drop-oldest
+            The oldest queued batch is discarded.
+        coalesce
+            The new samples are appended to the newest queued batch, so the
+            consumer gets fewer, larger batches.
+
+        The notification handler can't wait, so it uses `put`. Producers
+        that can, such as a capture file being replayed, should use
+        `put_wait`, which waits for room in the queue instead.
+
+        Parameters
+        ----------
+        maxsize: int
+            Maximum number of batches in the queue
+        overflow: str
+            One of "block", "drop-oldest" or "coalesce"
+        on_close: callable, optional
+            Called with the stream when it is closed
+        max_backlog: int
+            Maximum number of batches held back by the "block" policy
+        """
+        if overflow not in self.policies:
+            raise ValueError(f"overflow must be one of {self.policies}")
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.on_close = on_close
+        self.max_backlog = max_backlog
+        self._queue = collections.deque()
+        self._backlog = collections.deque()
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self.closed = False
+        # counters
+        self.batches = 0
+        self.blocked = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._queue) + len(self._backlog)
+
+    def put(self, times, weights):
+        if self.closed:
+            return
+        self.batches += 1
+        batch = (times, weights)
+        if len(self._queue) < self.maxsize and not self._backlog:
+            self._queue.append(batch)
+        elif self.overflow == "drop-oldest":
+            self._queue.popleft()
+            self._queue.append(batch)
+            self.dropped += 1
+        elif self.overflow == "coalesce":
+            last_times, last_weights = self._queue[-1]
+            self._queue[-1] = (
+                np.concatenate((last_times, times)),
+                np.concatenate((last_weights, weights)),
+            )
+            self.coalesced += 1
+        elif len(self._backlog) < self.max_backlog:
+            self._backlog.append(batch)
+            self.blocked += 1
+        else:
+            self.dropped += 1
+        self._ready.set()
+
+    async def put_wait(self, times, weights):
+        """
+        Put a batch on the queue, waiting until there is room for it
+        """
+        while len(self) >= self.maxsize and not self.closed:
+            self._space.clear()
+            await self._space.wait()
+        self.put(times, weights)
+
+    def close(self):
+        """
+        Stop accepting batches. Iteration ends once the queue is drained.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._ready.set()
+        self._space.set()
+        if self.on_close is not None:
+            self.on_close(self)
+
+    async def aclose(self):
+        self.close()
+
+    @property
+    def stats(self):
+        return dict(
+            batches=self.batches,
+            queued=len(self),
+            blocked=self.blocked,
+            dropped=self.dropped,
+            coalesced=self.coalesced,
+        )
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._queue:
+            if self.closed:
+                raise StopAsyncIteration
+            self._ready.clear()
+            await self._ready.wait()
+        batch = self._queue.popleft()
+        if self._backlog:
+            self._queue.append(self._backlog.popleft())
+        self._space.set()
+        return batch
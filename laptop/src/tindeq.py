@@ -1,16 +1,31 @@
+import os
+import json
+import time
 import struct
 import uuid
 import asyncio
+import collections
 
 import numpy as np
 
 from bleak import BleakClient, BleakScanner
 
+from .clock import DeviceClock
+from .metrics import StreamMetrics
+from .stats import RunningStats
+from .streaming import SampleStream
+
 # from bleak import _logger as logger
 
 
 class TindeqProgressor(object):
-    response_codes = {"cmd_resp": 0, "weight_measure": 1, "low_pwr": 4}
+    response_codes = {
+        "cmd_resp": 0,
+        "weight_measure": 1,
+        "rfd_peak": 2,
+        "rfd_peak_series": 3,
+        "low_pwr": 4,
+    }
     cmds = dict(
         TARE_SCALE=0x64,
         START_WEIGHT_MEAS=0x65,
@@ -28,8 +43,22 @@ class TindeqProgressor(object):
     service_uuid = "7e4e1701-1ea6-40c9-9dcc-13d34ffead57"
     write_uuid = "7e4e1703-1ea6-40c9-9dcc-13d34ffead57"
     notify_uuid = "7e4e1702-1ea6-40c9-9dcc-13d34ffead57"
-
-    def __init__(self, parent):
+    response_decoders = dict(
+        GET_BATT_VLTG=lambda payload: struct.unpack("<I", payload)[0],
+        GET_APP_VERSION=lambda payload: payload.decode("utf-8"),
+        GET_ERR_INFO=lambda payload: payload.decode("utf-8", errors="replace"),
+    )
+    command_timeout = 2.0
+    # how long after its timeout a request still claims a late response
+    late_response_window = 0.5
+    max_inflight = 4
+    rfd_kinds = (response_codes["rfd_peak"], response_codes["rfd_peak_series"])
+    sample_dtype = np.dtype([("weight", "<f4"), ("useconds", "<i4")])
+    # transport classes; swap for src.simulator versions to run without hardware
+    client_class = BleakClient
+    scanner_class = BleakScanner
+
+    def __init__(self, parent, device_cache=None):
         """
         Uses Bluetooth 4 (LE) to communicate with Tindeq Progressor
 
@@ -40,18 +69,34 @@ class TindeqProgressor(object):
         Use as a context manager:
 
             >>> aysnc with TindeqProgressor(parent) as tindeq:
-            >>>     await tindeq.get_batt()
+            >>>     battery_mv = await tindeq.get_batt()
 
         Parameters
         ----------
-        parent: object
+        parent: object or None
             An owning class that implements callbacks specifying
-            what to do when receiving weight notifications
+            what to do when receiving weight notifications. May be None
+            if samples are only consumed through `stream`.
+        device_cache: DeviceCache, optional
+            Store of known Progressor addresses, used to reconnect
+            without scanning. Defaults to a cache in the home directory.
         """
         self.parent = parent
+        self.device_cache = DeviceCache() if device_cache is None else device_cache
         self.info_struct = struct.Struct("<bb")
-        self.data_struct = struct.Struct("<fl")
         self._tare_value = 0.0
+        # (cmd_key, future) for requests awaiting a response, oldest first
+        self._pending = collections.deque()
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+        self._streams = []
+        # device timestamps, and their mapping to time.monotonic()
+        self.clock = DeviceClock()
+        self.metrics = StreamMetrics()
+        # optional CaptureWriter, which is given every raw frame
+        self.recorder = None
+        self.logging = False
+        self._tare_stats = None
+        self.tare_noise = None
 
     async def __aenter__(self):
         await self.connect()
@@ -60,70 +105,265 @@ class TindeqProgressor(object):
     async def __aexit__(self, *excinfo):
         await self.disconnect()
 
-    def _notify_handler(self, sender, data):
-        """
-        Simply pass on payload to correct handler
-        """
-        data = bytes(data)
-        kind, size = self.info_struct.unpack(data[:2])
-        if kind == self.response_codes["weight_measure"]:
-            # decode data
-            for weight, useconds in self.data_struct.iter_unpack(data[2:]):
-                now = useconds / 1.0e6
-                self.parent.log_force_sample(now, weight - self._tare_value)
-        elif kind == self.response_codes["cmd_resp"]:
-            self._cmd_response(data)
-        elif kind == self.response_codes["low_pwr"]:
-            print("low power warning")
+    def _decode_samples(self, data, tare=True):
+        """
+        Decode the samples in a notification payload.
+
+        Weight and RFD packets share the same layout. The payload is viewed
+        in place as a structured array, so no intermediate copy of the
+        packet is made. The device counter is unwrapped, so times keep
+        increasing through counter overflows.
+
+        Returns
+        -------
+        times: np.ndarray
+            Device timestamps in seconds
+        values: np.ndarray
+            Weights, with the soft tare removed if ``tare`` is True
+        """
+        samples = np.frombuffer(
+            data,
+            dtype=self.sample_dtype,
+            count=(len(data) - 2) // self.sample_dtype.itemsize,
+            offset=2,
+        )
+        times = self.clock.unwrap(samples["useconds"]) / 1.0e6
+        if not tare:
+            return times, samples["weight"]
+        weights = samples["weight"] - np.float32(self._tare_value)
+        return times, weights
+
+    def _log_samples(self, times, weights):
+        """
+        Hand a decoded packet to the parent.
+
+        Parents implementing ``log_force_samples(times, weights)`` receive
+        the whole packet in one call. Otherwise we fall back to calling
+        ``log_force_sample(time, weight)`` once per sample.
+        """
+        if self._tare_stats is not None:
+            self._tare_stats.update(weights)
+            if self._tare_stats.converged(*self._tare_criteria):
+                self._tare_done.set()
+        for stream in self._streams:
+            stream.put(times, weights)
+        if self.parent is None:
+            return
+        if hasattr(self.parent, "log_force_samples"):
+            self.parent.log_force_samples(times, weights)
         else:
-            raise RuntimeError(f"unknown msg kind {kind}")
+            for now, weight in zip(times.tolist(), weights.tolist()):
+                self.parent.log_force_sample(now, weight)
+
+    def _log_rfd_samples(self, times, values):
+        """
+        Hand a decoded RFD packet to the parent, in one call if possible
+        """
+        if hasattr(self.parent, "log_rfd_samples"):
+            self.parent.log_rfd_samples(times, values)
+        elif hasattr(self.parent, "log_rfd_sample"):
+            for now, value in zip(times.tolist(), values.tolist()):
+                self.parent.log_rfd_sample(now, value)
+
+    def stream(self, maxsize=64, overflow="block", max_backlog=1024):
+        """
+        Stream of (times, weights) batches, for use with ``async for``.
+
+            >>> async for times, weights in tindeq.stream(overflow="coalesce"):
+            >>>     plot(times, weights)
+
+        Batches are queued by the notification handler, so a slow consumer
+        never holds up the Bluetooth callbacks. The stream ends when it is
+        closed or the Progressor disconnects. See `SampleStream` for the
+        overflow policies.
+        """
+        stream = SampleStream(maxsize, overflow, self._streams.remove, max_backlog)
+        self._streams.append(stream)
+        return stream
+
+    def _notify_handler(self, sender, data, arrival=None):
+        """
+        Simply pass on payload to correct handler.
+
+        ``arrival`` is when the notification arrived (``time.monotonic()``
+        seconds), by default now. Replayed captures pass the recorded time.
+
+        Low power warnings go to the parent's ``log_low_power()``, if it has
+        one. Every notification, including unknown kinds, is counted in
+        ``metrics``.
+        """
+        if arrival is None:
+            arrival = time.monotonic()
+        start = time.perf_counter()
+        kind, size = self.info_struct.unpack_from(data)
+        self.metrics.record_notification(kind, self.response_codes)
+        if self.recorder is not None:
+            self.recorder.write(data, arrival)
+        try:
+            if kind == self.response_codes["weight_measure"]:
+                times, weights = self._decode_samples(data)
+                if len(times):
+                    self.clock.observe(times[-1], arrival)
+                self.metrics.record_samples(times)
+                self._log_samples(times, weights)
+            elif kind in self.rfd_kinds:
+                times, values = self._decode_samples(data, tare=False)
+                if len(times):
+                    self.clock.observe(times[-1], arrival)
+                self.metrics.record_samples(times)
+                self._log_rfd_samples(times, values)
+            elif kind == self.response_codes["cmd_resp"]:
+                self._cmd_response(bytes(data))
+            elif kind == self.response_codes["low_pwr"]:
+                # counted in the metrics; parents can also act on it
+                if hasattr(self.parent, "log_low_power"):
+                    self.parent.log_low_power()
+            # other kinds are only counted, as raising here would break the
+            # Bluetooth callback
+        finally:
+            self.metrics.record_callback(time.perf_counter() - start)
 
     def _cmd_response(self, value):
-        if self.last_cmd == "get_app":
-            print(f"FW version : {value[2:].decode('utf-8')}")
-        elif self.last_cmd == "get_batt":
-            (vdd,) = struct.unpack("<I", value[2:])
-            print(f"Battery level = {vdd} [mV]")
-        elif self.last_cmd == "get_err":
+        """
+        Resolve the oldest outstanding request with a command response.
+
+        The Progressor answers commands in the order they were sent, so
+        responses are matched to requests first in, first out. Responses
+        to requests that timed out, or nobody is waiting for, are ignored.
+        """
+        self._expire_pending()
+        if not self._pending:
+            return
+        cmd_key, future, _ = self._pending.popleft()
+        if future.done():
+            return
+        try:
+            future.set_result(self.response_decoders[cmd_key](value[2:]))
+        except Exception as err:
+            future.set_exception(err)
+
+    def _expire_pending(self):
+        """
+        Drop timed-out requests whose late response window has passed.
+
+        Their response was lost, so leaving them queued would hand every
+        later response to the request before it.
+        """
+        now = time.monotonic()
+        while self._pending:
+            _, future, deadline = self._pending[0]
+            if not (future.done() and deadline < now):
+                break
+            self._pending.popleft()
+
+    async def _request(self, cmd_key, timeout=None):
+        """
+        Send a command and wait for its response.
+
+        At most ``max_inflight`` requests are outstanding at once; further
+        requests wait for a slot.
+
+        Parameters
+        ----------
+        cmd_key: str
+            Key of the command in ``cmds``
+        timeout: float, optional
+            Seconds to wait for the response. Defaults to ``command_timeout``.
+        """
+        if getattr(self, "client", None) is None:
+            raise RuntimeError("not connected to progressor")
+        timeout = self.command_timeout if timeout is None else timeout
+        async with self._inflight:
+            future = asyncio.get_running_loop().create_future()
+            deadline = time.monotonic() + timeout + self.late_response_window
+            entry = (cmd_key, future, deadline)
+            self._expire_pending()
+            self._pending.append(entry)
             try:
-                print("Crashlog : {0}".format(value[2:].decode("utf-8")))
-            except UnicodeDecodeError:
-                pass
-        self.last_cmd = None
+                await self._send_cmd(cmd_key)
+            except BaseException:
+                # nothing was sent, so no response is coming
+                if entry in self._pending:
+                    self._pending.remove(entry)
+                raise
+            # a late response can still arrive after a timeout, so the
+            # cancelled future keeps its place in the queue until its
+            # deadline, to be matched and dropped
+            return await asyncio.wait_for(future, timeout)
 
     async def disconnect(self):
         await self._send_cmd("SLEEP")
+        for _, future, _ in self._pending:
+            future.cancel()
+        self._pending.clear()
+        for stream in list(self._streams):
+            stream.close()
         await self.client.disconnect()
         self.client = None
 
-    async def connect(self):
+    async def connect(self, address=None, scan_timeout=20.0, direct_timeout=5.0):
+        """
+        Connect to a Progressor.
+
+        A known address (``address`` if given, otherwise the most recently
+        used one in the device cache) is tried directly. Only if it doesn't
+        answer do we scan, stopping at the first device whose name starts
+        with "Progressor". Cached addresses that fail to connect several
+        times in a row are forgotten, so a station that rotates sensors
+        doesn't keep waiting on old ones.
+
+        Parameters
+        ----------
+        address: str, optional
+            Address of the Progressor to try first
+        scan_timeout: float
+            Give up scanning after this many seconds
+        direct_timeout: float
+            Timeout for the direct connection attempt
+        """
+        self.clock.reset()
+        self.metrics.reset()
+        if address is None:
+            address = next(iter(self.device_cache.addresses()), None)
+        if address is not None:
+            if await self._connect_client(address, timeout=direct_timeout):
+                print("Connected to known progressor at {0}".format(address))
+                self.device_cache.remember(address)
+                return True
+            self.device_cache.failed(address)
+
         print("Searching for progressor...")
-        scanner = BleakScanner()
-        devices = await scanner.discover(timeout=20.0)
         TARGET_NAME = "Progressor"
-        address = None
-        for d in devices:
-            if (
-              hasattr(d, 'name') and 
-              (d.name is not None) and 
-              (d.name[: len(TARGET_NAME)] == TARGET_NAME)):
-                address = d.address
-                print('Found "{0}" with address {1}'.format(d.name, d.address))
-                break
 
-        if address is None:
+        def is_progressor(device, adv):
+            name = getattr(device, "name", None) or getattr(adv, "local_name", None)
+            return name is not None and name[: len(TARGET_NAME)] == TARGET_NAME
+
+        scanner = self.scanner_class()
+        device = await scanner.find_device_by_filter(is_progressor, timeout=scan_timeout)
+        if device is None:
             raise RuntimeError("cannot find tindeq")
+        print('Found "{0}" with address {1}'.format(device.name, device.address))
 
-        self.client = BleakClient(address)
-        await self.client.connect()
-        success = self.client.is_connected
-        if success:
-            await self.client.start_notify(
-                uuid.UUID(self.notify_uuid), self._notify_handler
-            )
-        else:
+        if not await self._connect_client(device):
             raise RuntimeError("could not connect to progressor")
-        return success
+        self.device_cache.remember(device.address, device.name)
+        return True
+
+    async def _connect_client(self, address_or_device, **kwargs):
+        """
+        Try to connect and subscribe to notifications. Returns success.
+        """
+        client = self.client_class(address_or_device, **kwargs)
+        try:
+            await client.connect()
+        except Exception:
+            return False
+        if not client.is_connected:
+            return False
+        self.client = client
+        await self.client.start_notify(uuid.UUID(self.notify_uuid), self._notify_handler)
+        return True
 
     def _pack(self, cmd):
         return cmd.to_bytes(2, byteorder="little")
@@ -136,54 +376,173 @@ class TindeqProgressor(object):
             uuid.UUID(self.write_uuid), self._pack(self.cmds[cmd_key])
         )
 
-    async def get_batt(self):
-        self.last_cmd = "get_batt"
-        await self._send_cmd("GET_BATT_VLTG")
+    async def get_batt(self, timeout=None):
+        """
+        Battery voltage in mV
+        """
+        return await self._request("GET_BATT_VLTG", timeout)
+
+    async def get_fw_info(self, timeout=None):
+        """
+        Firmware version string
+        """
+        return await self._request("GET_APP_VERSION", timeout)
 
-    async def get_fw_info(self):
-        self.last_cmd = "get_app"
-        await self._send_cmd("GET_APP_VERSION")
+    async def get_err(self, timeout=None):
+        """
+        Crash log stored on the device
+        """
+        return await self._request("GET_ERR_INFO", timeout)
 
-    async def get_err(self):
-        self.last_cmd = "get_err"
-        await self._send_cmd("GET_ERR_INFO")
+    async def health_check(self, timeout=None):
+        """
+        Battery, firmware and crash log, requested back to back
+        """
+        battery_mv, firmware, crash_log = await asyncio.gather(
+            self.get_batt(timeout), self.get_fw_info(timeout), self.get_err(timeout)
+        )
+        return dict(battery_mv=battery_mv, firmware=firmware, crash_log=crash_log)
 
     async def clear_err(self):
-        self.last_cmd = None
         await self._send_cmd("CLR_ERR_INFO")
 
     async def start_logging_weight(self):
-        self.last_cmd = None
+        self.logging = True
         await self._send_cmd("START_WEIGHT_MEAS")
 
     async def stop_logging_weight(self):
-        self.last_cmd = None
+        self.logging = False
         await self._send_cmd("STOP_WEIGHT_MEAS")
 
+    async def start_peak_rfd(self):
+        """
+        Measure peak rate of force development.
+
+        Results are passed to the parent's ``log_rfd_samples(times, values)``
+        or, failing that, ``log_rfd_sample(time, value)``. Stop with
+        `stop_logging_weight`.
+        """
+        self.logging = True
+        await self._send_cmd("START_PEAK_RFD_MEAS")
+
+    async def start_peak_rfd_series(self):
+        """
+        Measure a series of peak rate of force development values.
+
+        Results are delivered as for `start_peak_rfd`.
+        """
+        self.logging = True
+        await self._send_cmd("START_PEAK_RFD_MEAS_SERIES")
+
     async def sleep(self):
-        self.last_cmd = None
         await self._send_cmd("SLEEP")
 
-    async def soft_tare(self):
-        _saved_parent = self.parent
-        self.parent = SampleAverage()
-        await self.start_logging_weight()
-        await asyncio.sleep(1)
-        await self.stop_logging_weight()
-        self._tare_value = self.parent.mean
-        self.parent = _saved_parent
+    async def soft_tare(self, tolerance=0.01, timeout=2.0, min_samples=10):
+        """
+        Zero the weight readings in software.
+
+        Keeps running statistics of the readings and finishes as soon as the
+        standard error on the mean drops below ``tolerance`` (kg), or after
+        ``timeout`` seconds. Samples keep flowing to the parent and any
+        streams throughout.
+
+        Returns
+        -------
+        result: dict
+            The new tare value, the measured noise level (standard
+            deviation, kg), the number of samples used, and whether the
+            tolerance was reached before the timeout.
+        """
+        self._tare_stats = stats = RunningStats()
+        self._tare_done = asyncio.Event()
+        self._tare_criteria = (tolerance, min_samples)
+        started_logging = not self.logging
+        if started_logging:
+            await self.start_logging_weight()
+        try:
+            await asyncio.wait_for(self._tare_done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._tare_stats = None
+            if started_logging:
+                await self.stop_logging_weight()
+
+        if stats.count == 0:
+            raise RuntimeError("no samples received during soft tare")
+        self._tare_value += stats.mean
+        self.tare_noise = stats.std
+        return dict(
+            tare=float(self._tare_value),
+            noise=float(stats.std),
+            samples=stats.count,
+            converged=bool(stats.converged(tolerance, min_samples)),
+        )
+
+
+class DeviceCache:
+    default_path = os.path.join(os.path.expanduser("~"), ".pytindeq_devices.json")
+
+    def __init__(self, path=default_path):
+        """
+        Persistent record of Progressor addresses we have connected to.
+
+        Parameters
+        ----------
+        path: str or None
+            JSON file to keep the cache in. None keeps it in memory only.
+        """
+        self.path = path
+        self.devices = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.devices = json.load(f)
+            except (OSError, ValueError):
+                self.devices = {}
+
+    def addresses(self):
+        """
+        Known addresses, most recently used first
+        """
+        return sorted(
+            self.devices, key=lambda a: self.devices[a]["last_seen"], reverse=True
+        )
 
+    def remember(self, address, name=None):
+        entry = self.devices.setdefault(address, {"name": name})
+        if name is not None:
+            entry["name"] = name
+        entry["last_seen"] = time.time()
+        entry["failures"] = 0
+        self._save()
 
-class SampleAverage:
-    def __init__(self):
-        self.weights = []
+    def failed(self, address, max_failures=3):
+        """
+        Note a failed connection, forgetting the address after max_failures
+        in a row
+        """
+        entry = self.devices.get(address)
+        if entry is None:
+            return
+        entry["failures"] = entry.get("failures", 0) + 1
+        if entry["failures"] >= max_failures:
+            self.forget(address)
+        else:
+            self._save()
 
-    def log_force_sample(self, time, weight):
-        self.weights.append(weight)
+    def forget(self, address):
+        self.devices.pop(address, None)
+        self._save()
 
-    @property
-    def mean(self):
-        return np.mean(self.weights)
+    def _save(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path, "w") as f:
+                json.dump(self.devices, f, indent=2)
+        except OSError as err:
+            print(f"could not save device cache: {err}")
 
 
 async def example():
@@ -193,14 +552,10 @@ async def example():
 
     wrap = Wrapper()
     async with TindeqProgressor(wrap) as tindeq:
-        await tindeq.get_batt()
-        await asyncio.sleep(0.5)
-        await tindeq.get_fw_info()
-        await asyncio.sleep(0.5)
-        await tindeq.get_err()
-        await asyncio.sleep(0.5)
+        print(f"Battery level = {await tindeq.get_batt()} [mV]")
+        print(f"FW version : {await tindeq.get_fw_info()}")
+        print(f"Crashlog : {await tindeq.get_err()}")
         await tindeq.clear_err()
-        await asyncio.sleep(0.5)
 
         await tindeq.soft_tare()
         await asyncio.sleep(1)
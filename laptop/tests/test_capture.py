@@ -0,0 +1,35 @@
+import asyncio
+
+import numpy as np
+
+from src.capture import CaptureReader, CaptureWriter
+from src.simulator import weight_packet
+from src.tindeq import TindeqProgressor, DeviceCache
+
+
+class Sink:
+    def __init__(self):
+        self.weights = []
+
+    def log_force_samples(self, times, weights):
+        self.weights.append(weights)
+
+
+def test_replay_matches_the_capture(tmp_path):
+    live = TindeqProgressor(Sink(), DeviceCache(path=None))
+    live._tare_value = 0.5
+    path = tmp_path / "test.tdqcap"
+    with CaptureWriter(path, tare=live._tare_value) as recorder:
+        live.recorder = recorder
+        for i in range(200):
+            useconds = 12500 * (8 * i + np.arange(8))
+            arrival = 1000.0 + (useconds[-1] + 30000) / 1.0e6
+            live._notify_handler(None, weight_packet(np.full(8, 10.0 + i), useconds), arrival)
+
+    capture = CaptureReader(path)
+    assert capture.tare == 0.5
+    replayed = asyncio.run(capture.replay(Sink()))
+    np.testing.assert_array_equal(
+        np.concatenate(replayed.parent.weights), np.concatenate(live.parent.weights)
+    )
+    assert abs(replayed.clock.to_host(1.0) - live.clock.to_host(1.0)) < 1e-9
@@ -0,0 +1,23 @@
+import numpy as np
+
+from src.codec import archive_session, restore_session
+from src.session import Session, save_session
+from src.simulator import synthetic_trace
+
+
+def test_archive_round_trip_keeps_the_header(tmp_path):
+    t, f = synthetic_trace(reps=24, seed=1)
+    original = tmp_path / "original.tdqs"
+    save_session(original, t, f, 7, 3, tare=0.25, trigger_level="auto", grip="edge")
+    archive = tmp_path / "original.tdqz"
+    archive_session(original, archive)
+    restored = tmp_path / "restored.tdqs"
+    restore_session(archive, restored)
+
+    before, after = Session(original), Session(restored)
+    assert {k: v for k, v in after.header.items() if k != "arrays"} == {
+        k: v for k, v in before.header.items() if k != "arrays"
+    }
+    np.testing.assert_array_equal(after.weights, before.weights)
+    np.testing.assert_allclose(after.times, before.times, atol=5e-7)
+    assert after.reps("auto") is not None
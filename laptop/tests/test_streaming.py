@@ -0,0 +1,38 @@
+import asyncio
+
+import numpy as np
+
+from src.streaming import SampleStream
+
+
+def batch(i):
+    return np.array([float(i)]), np.array([float(i)], dtype=np.float32)
+
+
+def test_block_backlog_is_bounded():
+    stream = SampleStream(maxsize=2, overflow="block", max_backlog=3)
+    for i in range(10):
+        stream.put(*batch(i))
+    assert len(stream) == 5
+    assert stream.stats["blocked"] == 3
+    assert stream.stats["dropped"] == 5
+
+
+def test_put_wait_waits_for_the_consumer():
+    async def run():
+        stream = SampleStream(maxsize=2)
+
+        async def produce():
+            for i in range(20):
+                await stream.put_wait(*batch(i))
+                assert len(stream) <= 2
+            stream.close()
+
+        producer = asyncio.create_task(produce())
+        received = [times[0] async for times, _ in stream]
+        await producer
+        return stream, received
+
+    stream, received = asyncio.run(run())
+    assert received == list(range(20))
+    assert stream.stats["blocked"] == 0
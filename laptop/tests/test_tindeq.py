@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from src import simulator
+from src.tindeq import TindeqProgressor, DeviceCache
+
+
+@pytest.fixture
+def device():
+    device = simulator.add_device(latency=0.2)
+    yield device
+    simulator.devices.pop(device.address, None)
+
+
+def test_late_response_is_dropped(device):
+    async def run():
+        tindeq = simulator.use_simulator(TindeqProgressor(None, DeviceCache(path=None)))
+        await tindeq.connect()
+        with pytest.raises(asyncio.TimeoutError):
+            await tindeq.get_batt(timeout=0.05)
+        # the battery reply arrives now, and must not answer these
+        assert await tindeq.get_fw_info() == device.firmware
+        assert await tindeq.get_batt() == device.battery_mv
+        await tindeq.disconnect()
+
+    asyncio.run(run())
+
+
+def test_low_power_and_unknown_kinds():
+    class Parent:
+        warnings = 0
+
+        def log_low_power(self):
+            self.warnings += 1
+
+    parent = Parent()
+    tindeq = TindeqProgressor(parent, DeviceCache(path=None))
+    tindeq._notify_handler(None, simulator.response_packet(kind=TindeqProgressor.response_codes["low_pwr"]))
+    tindeq._notify_handler(None, simulator.response_packet(kind=42))
+    assert parent.warnings == 1
+    snapshot = tindeq.metrics.snapshot()
+    assert snapshot["low_power_events"] == 1
+    assert snapshot["unknown_packets"] == 1
+
+
+def test_stale_addresses_are_forgotten(device):
+    stale = "OL:DS:EN:SO:R0:00"
+    cache = DeviceCache(path=None)
+    cache.remember(stale)
+    # stays the most recent, so it is tried first every time
+    cache.devices[stale]["last_seen"] = float("inf")
+
+    async def run():
+        tindeq = simulator.use_simulator(TindeqProgressor(None, cache))
+        for _ in range(3):
+            assert stale in cache.devices
+            await tindeq.connect()
+            await tindeq.disconnect()
+
+    asyncio.run(run())
+    assert cache.addresses() == [device.address]
+
+
+def test_lost_response_does_not_jam_commands(device):
+    async def run():
+        tindeq = simulator.use_simulator(TindeqProgressor(None, DeviceCache(path=None)))
+        tindeq.late_response_window = 0.1
+        await tindeq.connect()
+        respond = device._respond
+        device._respond = lambda payload: None
+        with pytest.raises(asyncio.TimeoutError):
+            await tindeq.get_batt(timeout=0.05)
+        device._respond = respond
+        await asyncio.sleep(0.1)
+        for _ in range(3):
+            assert await tindeq.get_fw_info(timeout=0.5) == device.firmware
+        assert len(tindeq._pending) == 0
+        await tindeq.disconnect()
+
+    asyncio.run(run())